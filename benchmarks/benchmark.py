@@ -0,0 +1,154 @@
+"""
+End-to-end benchmark of segevmusic against local stand-ins of its upstream services.
+Drives MusicDownloader through resolving a playlist (and optionally searches and other
+platforms' links), downloading, tagging, renaming and uploading, and reports songs/minute
+and every stage's wall time.
+
+    python benchmarks/benchmark.py --songs 500 --jobs 8 --latency 0.05 --error-rate 0.02
+"""
+from upstream import FakeUpstream, StubDownloader, StubDeezerApp, generate_download_object, generate_track_item, \
+    point_wetransfer_at, SERVICES, METADATA_SERVICES
+from argparse import ArgumentParser, Namespace
+from tempfile import TemporaryDirectory
+from os.path import join
+from time import perf_counter
+from json import dump
+import sys
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="benchmark segevmusic against local fake upstream services")
+    parser.add_argument("--songs", help="number of songs in the benchmark playlist", type=int, default=200)
+    parser.add_argument("--album-size", help="number of songs in every album", type=int, default=10)
+    parser.add_argument("--searches", help="number of songs to add by searching", type=int, default=0)
+    parser.add_argument("--foreign-links", help="number of songs to add by other platforms' links (song.link)",
+                        type=int, default=0)
+    parser.add_argument("-j", "--jobs", help="number of songs to download in parallel", type=int, default=3)
+    parser.add_argument("-u", "--upload", help="upload the songs to the fake wetransfer", action="store_true")
+    parser.add_argument("--upload-workers", help="number of chunks to upload in parallel", type=int, default=4)
+    parser.add_argument("--song-size", help="size of every song in KB", type=int, default=4096)
+    parser.add_argument("--artwork-size", help="size of every artwork in KB", type=int, default=200)
+    parser.add_argument("--latency", help="seconds every metadata request waits", type=float, default=0.0)
+    parser.add_argument("--media-latency", help="seconds every song download waits", type=float, default=0.0)
+    parser.add_argument("--error-rate", help="fraction of requests failing with a 503", type=float, default=0.0)
+    parser.add_argument("--error-service", help="a service whose requests may fail (defaults to the metadata ones)",
+                        action='append', choices=SERVICES, dest='error_services')
+    parser.add_argument("--rate", help="requests per second allowed to the fake services (the per-host limit)",
+                        type=float, default=1000.0)
+    parser.add_argument("--seed", help="seed of the injected errors", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this json file")
+    return parser.parse_args()
+
+
+def point_at(upstream: FakeUpstream, rate: float):
+    """
+    Points every upstream url used by segevmusic at the fake upstream, replaces deemix with
+    the download stubs and lets the fake host be requested at the given rate.
+    """
+    from segevmusic import applemusic, utils, deezr, limiter, music_downloader
+    base_url = upstream.base_url
+    music_downloader.AM_DOMAIN = base_url
+    applemusic.AM_QUERY = base_url + '/search?types=songs,albums&term={name}&limit={limit}&l={language}'
+    applemusic.ITUNES_SONG_QUERY = base_url + '/itunes/lookup?id={id}&entity=song&l={language}'
+    applemusic.ITUNES_ALBUM_QUERY = base_url + '/itunes/lookup?id={id}&entity=album&l={language}'
+    applemusic.ITUNES_GENRE_QUERY = base_url + '/itunes/lookup?id={id}&l=en'
+    applemusic.AM_API_URL = base_url + '/amp'
+    utils.ODESLI_URL = base_url + '/odesli/links?url={url}'
+    deezr.DEEZER_ISRC_QUERY = base_url + '/deezer/2.0/track/isrc:{isrc}'
+    deezr.generateDownloadObject = generate_download_object
+    deezr.generateTrackItem = generate_track_item
+    deezr.Downloader = StubDownloader
+    StubDownloader.media_url = base_url + '/deezer/media'
+    point_wetransfer_at(base_url)
+    limiter.HOST_RATES['127.0.0.1'] = (rate, max(int(rate), 1))
+
+
+def run(args: Namespace, upstream: FakeUpstream, work_dir: str) -> dict:
+    """
+    Runs a single benchmark, and returns its results.
+    """
+    from segevmusic.music_downloader import MusicDownloader
+    from segevmusic.wetransfer import WTSession
+    download_path = join(work_dir, 'Songs')
+    catalog = upstream.catalog
+    downloader = MusicDownloader(MusicDownloader.get_args([download_path, '--no-cache', '--jobs', str(args.jobs)]))
+    downloader.app = StubDeezerApp(download_path, args.jobs)
+    stages = {}
+    upload_error = None
+
+    start = perf_counter()
+    downloader.get_songs_link(catalog.playlist_url())
+    if args.searches:
+        downloader.get_songs_lines([f"Song {index}" for index in range(args.searches)])
+    if args.foreign_links:
+        downloader.get_songs_lines([f"https://open.spotify.com/track/{index}" for index in range(args.foreign_links)],
+                                   links=True)
+    downloader.start_resolving()
+    stages['resolve'] = perf_counter() - start
+
+    stage_start = perf_counter()
+    downloader.download()
+    stages['download'] = perf_counter() - stage_start
+    first_file_time = downloader.first_file_time
+
+    if args.upload:
+        stage_start = perf_counter()
+        try:
+            downloader.wt_session = WTSession(args.upload_workers, join(work_dir, 'wetransfer-journals'))
+            downloader.upload()
+        except Exception as e:
+            upload_error = str(e)
+        stages['upload'] = perf_counter() - stage_start
+    wall_time = perf_counter() - start
+
+    return {
+        'songs': len({song.isrc for song in downloader.added_songs}),
+        'downloaded': len(downloader.downloaded_songs),
+        'files': len(downloader.songs_files),
+        'wall_time': wall_time,
+        'songs_per_minute': len(downloader.songs_files) / wall_time * 60 if wall_time else 0.0,
+        'first_song_time': first_file_time,
+        'stages': stages,
+        'requests': dict(upstream.requests),
+        'injected_errors': dict(upstream.injected_errors),
+        'uploaded_bytes': upstream.uploaded_bytes,
+        'upload_error': upload_error
+    }
+
+
+def report(results: dict):
+    print("\n--> Benchmark results:")
+    print(f"Songs: {results['songs']} added (unique), {results['downloaded']} downloaded, {results['files']} finished")
+    print(f"Throughput: {results['songs_per_minute']:.1f} songs/minute")
+    if results['first_song_time'] is not None:
+        print(f"First song ready after: {results['first_song_time']:.2f}s")
+    for stage, seconds in results['stages'].items():
+        print(f"  {stage:<10} {seconds:8.2f}s")
+    print(f"  {'total':<10} {results['wall_time']:8.2f}s")
+    if results['upload_error']:
+        print(f"Upload failed: {results['upload_error']}")
+    print("Requests per service (injected errors):")
+    for service, count in sorted(results['requests'].items()):
+        print(f"  {service:<18} {count:6} ({results['injected_errors'].get(service, 0)})")
+
+
+def main():
+    args = get_args()
+    upstream = FakeUpstream(args.songs, args.album_size, args.song_size * 1024, args.artwork_size * 1024,
+                            args.latency, args.media_latency, args.error_rate,
+                            args.error_services or METADATA_SERVICES, args.seed).start()
+    point_at(upstream, args.rate)
+    try:
+        with TemporaryDirectory() as work_dir:
+            results = run(args, upstream, work_dir)
+    finally:
+        upstream.stop()
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            dump(dict(results, args=vars(args)), f, indent=2)
+    return 0 if results['files'] == results['songs'] and not results['upload_error'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Import time gate of segevmusic's command line - runs `python -X importtime -m segevmusic --help`, and fails
+(exits with 1) if a heavy dependency is imported just for parsing arguments, or if importing segevmusic
+takes longer than the budget.
+
+    python benchmarks/import_time.py --budget-ms 150 --runs 5
+"""
+from argparse import ArgumentParser, Namespace
+from subprocess import run, PIPE, DEVNULL
+from time import perf_counter
+import sys
+
+HEAVY_MODULES = ('requests', 'deemix', 'deezer', 'mutagen')
+COMMAND = [sys.executable, '-X', 'importtime', '-m', 'segevmusic', '--help']
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="check the import time of segevmusic's command line")
+    parser.add_argument("--budget-ms", help="milliseconds importing segevmusic may take", type=float, default=150.0)
+    parser.add_argument("--runs", help="number of runs (the fastest one is measured)", type=int, default=5)
+    return parser.parse_args()
+
+
+def measure() -> dict:
+    """
+    Runs the command line once, and returns its wall time, the cumulative time of importing
+    segevmusic and the imported modules.
+    """
+    start = perf_counter()
+    process = run(COMMAND, stdout=DEVNULL, stderr=PIPE, universal_newlines=True, check=True)
+    wall_time = perf_counter() - start
+    modules = set()
+    import_time = 0
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        # Top level imports (not indented) of segevmusic include all of their own imports:
+        if name.startswith(' segevmusic'):
+            import_time += int(cumulative)
+    return {'wall_time': wall_time, 'import_time': import_time / 1e6, 'modules': modules}
+
+
+def main():
+    args = get_args()
+    runs = [measure() for _ in range(args.runs)]
+    best = min(runs, key=lambda result: result['import_time'])
+    heavy_modules = sorted({module.split('.')[0] for module in best['modules']} & set(HEAVY_MODULES))
+    print(f"Importing segevmusic: {best['import_time'] * 1000:.1f}ms (budget: {args.budget_ms:.0f}ms)")
+    print(f"Running '--help': {min(result['wall_time'] for result in runs) * 1000:.1f}ms")
+    failed = False
+    if heavy_modules:
+        print(f"FAILED: heavy modules were imported: {', '.join(heavy_modules)}")
+        failed = True
+    if best['import_time'] * 1000 > args.budget_ms:
+        print("FAILED: importing segevmusic is over the budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Benchmark of reading the item of a large Apple Music playlist page - streaming only the shoebox script
+and decoding only its item's entry (get_content_between + _shoebox_entry), against reading the whole page,
+finding the shoebox with a regex and decoding the whole shoebox twice (get().content + double loads).
+Reports every way's peak memory and latency, against a local stand-in of Apple Music.
+
+    python benchmarks/shoebox.py --tracks 5000 --padding 4096 --runs 5
+"""
+from upstream import FakeUpstream
+from argparse import ArgumentParser, Namespace
+from json import loads
+from re import search
+from time import perf_counter
+import tracemalloc
+import sys
+
+SHOEBOX_REGEX = b'<script type="fastboot/shoebox" id="shoebox-media-api-cache-amp-music">(.*?)</script>'
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="benchmark reading the item of large apple music playlist pages")
+    parser.add_argument("--tracks", help="number of tracks embedded in the playlist page", type=int, default=5000)
+    parser.add_argument("--padding", help="size of the shoebox entry before the item's entry in KB", type=int,
+                        default=4096)
+    parser.add_argument("--runs", help="number of times every way is measured", type=int, default=5)
+    return parser.parse_args()
+
+
+def read_whole_page(url: str) -> dict:
+    """
+    The former way - the whole page is read, and the whole shoebox is decoded twice.
+    """
+    from segevmusic.fetcher import get
+    html = get(url).content
+    json = loads(search(SHOEBOX_REGEX, html).group(1))
+    return loads(json[list(json.keys())[1]])['d'][0]
+
+
+def read_shoebox_entry(url: str) -> dict:
+    """
+    The current way - only the shoebox is kept while streaming, and only its item's entry is decoded.
+    """
+    from segevmusic.applemusic import AMFunctions, AM_SHOEBOX_START, AM_SHOEBOX_END, AM_SHOEBOX_ENTRY
+    from segevmusic.fetcher import get_content_between
+    shoebox = get_content_between(url, AM_SHOEBOX_START, AM_SHOEBOX_END)
+    return loads(AMFunctions._shoebox_entry(shoebox.decode(), AM_SHOEBOX_ENTRY))['d'][0]
+
+
+def measure(read, url: str, runs: int) -> dict:
+    """
+    Returns the peak memory (of the worst run) and mean and best latencies of reading the given url.
+    """
+    latencies = []
+    peak = 0
+    for _ in range(runs):
+        tracemalloc.start()
+        start = perf_counter()
+        item = read(url)
+        latencies.append(perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        del item
+    return {'peak': peak, 'mean': sum(latencies) / len(latencies), 'best': min(latencies)}
+
+
+def main():
+    args = get_args()
+    from segevmusic import limiter
+    from segevmusic.fetcher import configure_cache
+    configure_cache(enabled=False)
+    limiter.HOST_RATES['127.0.0.1'] = (1000.0, 1000)
+    upstream = FakeUpstream(args.tracks, song_size=0, artwork_size=0, page_tracks=args.tracks,
+                            page_padding=args.padding * 1024).start()
+    url = upstream.catalog.playlist_url()
+    try:
+        if read_whole_page(url) != read_shoebox_entry(url):
+            print("FAILED: the ways read different items")
+            return 1
+        results = {read.__name__: measure(read, url, args.runs) for read in (read_whole_page, read_shoebox_entry)}
+    finally:
+        upstream.stop()
+    print(f"Playlist page of {args.tracks} tracks (+{args.padding}KB shoebox entry), {args.runs} runs:")
+    for name, result in results.items():
+        print(f"  {name:<20} peak {result['peak'] / 1024 / 1024:8.1f}MB   "
+              f"mean {result['mean'] * 1000:8.1f}ms   best {result['best'] * 1000:8.1f}ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Benchmark of uploading large files to WeTransfer - chunks sliced from a memory-mapped file (the current way),
+against chunks read with an f.read() loop (the former way). Reports every way's peak memory (tracemalloc)
+and throughput, first of chunking and CRC-ing the file alone, and then of uploading it to a local stand-in
+of WeTransfer.
+
+    python benchmarks/upload.py --size-mb 4096 --workers 4
+"""
+from upstream import FakeUpstream, point_wetransfer_at
+from argparse import ArgumentParser, Namespace
+from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+from mmap import mmap, ACCESS_READ
+from os.path import join, basename
+from time import perf_counter
+from zlib import crc32
+import tracemalloc
+import sys
+
+MB = 1024 * 1024
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(description="benchmark memory-mapped wetransfer uploads against read() loops")
+    parser.add_argument("--size-mb", help="size of the uploaded file in MB", type=int, default=1024)
+    parser.add_argument("--workers", help="number of chunks to upload in parallel", type=int, default=4)
+    parser.add_argument("--skip-upload", help="only measure chunking the file", action="store_true")
+    return parser.parse_args()
+
+
+def chunk_read_loop(path: str, chunk_size: int) -> int:
+    with open(path, 'rb') as f:
+        chunks = 0
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return chunks
+            crc32(chunk)
+            chunks += 1
+
+
+def chunk_mmap(path: str, chunk_size: int) -> int:
+    with open(path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mapped_file, \
+            memoryview(mapped_file) as view:
+        chunks = 0
+        for offset in range(0, len(view), chunk_size):
+            with view[offset:offset + chunk_size] as chunk:
+                crc32(chunk)
+            chunks += 1
+        return chunks
+
+
+def read_loop_session():
+    """
+    Returns a WTSession class whose chunks are read with an f.read() loop, as they were before
+    files were memory-mapped (chunks are still uploaded concurrently, so only the reading differs).
+    """
+    from segevmusic.wetransfer import WTSession, WETRANSFER_DEFAULT_CHUNK_SIZE, WETRANSFER_FINALIZE_MPP_URL, PUT_JSON
+
+    class ReadLoopSession(WTSession):
+        def put_read_chunk(self, url: str, chunk: bytes, file: str):
+            self.parts_session.options(url, headers=PUT_JSON)
+            self.parts_session.put(url, data=chunk).raise_for_status()
+            self._chunk_uploaded(file)
+
+        def upload_chunks(self, transfer_id: str, file_id: str, file: str,
+                          default_chunk_size: int = WETRANSFER_DEFAULT_CHUNK_SIZE, size: int = None,
+                          uploaded_chunks=frozenset()) -> str:
+            chunk_number = 0
+            pending_chunks = BoundedSemaphore(self.upload_workers * 2)
+            futures = []
+            with open(file, 'rb') as f, ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+                while True:
+                    pending_chunks.acquire()
+                    chunk = f.read(default_chunk_size)
+                    if not chunk:
+                        pending_chunks.release()
+                        break
+                    chunk_number += 1
+                    url = self.get_part_put_url(transfer_id, file_id, chunk_number, chunk)
+                    future = executor.submit(self.put_read_chunk, url, chunk, file)
+                    future.add_done_callback(lambda _: pending_chunks.release())
+                    futures.append(future)
+                for future in futures:
+                    future.result()
+            print(f"\r--> Finished uploading {basename(file)}.")
+            j = {'chunk_count': chunk_number}
+            url = WETRANSFER_FINALIZE_MPP_URL.format(transfer_id=transfer_id, file_id=file_id)
+            return self.transfer_request('put', url, json=j)
+
+    return ReadLoopSession
+
+
+def measure(function, *args) -> dict:
+    tracemalloc.start()
+    start = perf_counter()
+    function(*args)
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds, 'peak': peak}
+
+
+def upload(session_class, path: str, workers: int, journals_dir: str):
+    session_class(workers, journals_dir).upload([path], 'benchmark')
+
+
+def report(title: str, results: dict, size: int):
+    print(title)
+    for name, result in results.items():
+        print(f"  {name:<12} peak {result['peak'] / MB:8.1f}MB   {size / MB / result['seconds']:8.1f}MB/s")
+
+
+def main():
+    args = get_args()
+    from segevmusic.wetransfer import WTSession, WETRANSFER_DEFAULT_CHUNK_SIZE
+    size = args.size_mb * MB
+    with TemporaryDirectory() as work_dir:
+        path = join(work_dir, 'benchmark.bin')
+        with open(path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(b'\xa5' * MB)
+        report(f"Chunking and CRC-ing a {args.size_mb}MB file:", {
+            'read loop': measure(chunk_read_loop, path, WETRANSFER_DEFAULT_CHUNK_SIZE),
+            'mmap': measure(chunk_mmap, path, WETRANSFER_DEFAULT_CHUNK_SIZE)
+        }, size)
+        if args.skip_upload:
+            return 0
+        upstream = FakeUpstream(0, song_size=0, artwork_size=0).start()
+        point_wetransfer_at(upstream.base_url)
+        try:
+            results = {
+                'read loop': measure(upload, read_loop_session(), path, args.workers, join(work_dir, 'read-journals')),
+                'mmap': measure(upload, WTSession, path, args.workers, join(work_dir, 'mmap-journals'))
+            }
+        finally:
+            upstream.stop()
+        if upstream.uploaded_bytes != 2 * size:
+            print(f"FAILED: uploaded {upstream.uploaded_bytes} bytes instead of {2 * size}")
+            return 1
+        report(f"Uploading a {args.size_mb}MB file with {args.workers} workers:", results, size)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
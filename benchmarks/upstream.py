@@ -0,0 +1,523 @@
+"""
+Local stand-ins for every upstream service segevmusic talks to - Apple Music pages and web API,
+iTunes lookups, song.link, the Deezer API and media, artworks and WeTransfer's v4 API -
+served from a generated catalog, with configurable latency and error injection.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, quote
+from threading import Thread, Lock
+from collections import Counter
+from random import Random
+from tempfile import NamedTemporaryFile
+from json import dumps
+from os import remove
+from time import sleep
+import re
+
+PAGE_SIZE = 100
+DRAIN_CHUNK_SIZE = 64 * 1024
+MPEG_FRAME = b'\xff\xfb\x90\x00' + bytes(413)
+JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00'
+SHOEBOX_START = '<script type="fastboot/shoebox" id="shoebox-media-api-cache-amp-music">'
+ENVIRONMENT_META = '<meta name="desktop-music-app/config/environment" content="{content}">'
+PLAYLIST_ID = 'pl.benchmark'
+MEDIA_API_TOKEN = 'benchmark-token'
+SERVICES = ('apple-music', 'apple-music-api', 'apple-search', 'itunes', 'artwork', 'odesli', 'deezer-api',
+            'deezer-media', 'wetransfer', 'wetransfer-parts')
+METADATA_SERVICES = ('apple-music', 'apple-music-api', 'apple-search', 'itunes', 'artwork', 'odesli', 'deezer-api')
+
+
+def synthetic_mp3(size: int) -> bytes:
+    """
+    Returns an ID3 tagged mp3 payload of (about) the given size, made of silent MPEG frames.
+    """
+    from mutagen.id3 import ID3, TIT2
+    with NamedTemporaryFile(suffix='.mp3', delete=False) as f:
+        f.write(MPEG_FRAME * max(size // len(MPEG_FRAME), 1))
+    try:
+        tag = ID3()
+        tag.add(TIT2(text='benchmark'))
+        tag.save(f.name)
+        with open(f.name, 'rb') as f:
+            return f.read()
+    finally:
+        remove(f.name)
+
+
+class Catalog:
+    """
+    A generated catalog of albums and their songs, in Apple Music's and iTunes' json formats.
+    Song 'i' is in album 'i // album_size', and has the ISRC 'BENCH<i>'.
+    """
+
+    def __init__(self, base_url: str, songs: int, album_size: int = 10):
+        self.base_url = base_url
+        self.songs = songs
+        self.album_size = album_size
+
+    @staticmethod
+    def song_id(index: int) -> str:
+        return str(100000 + index)
+
+    @staticmethod
+    def album_id(album: int) -> str:
+        return str(1000 + album)
+
+    @staticmethod
+    def isrc(index: int) -> str:
+        return f"BENCH{index:07d}"
+
+    def index_of(self, song_id: str) -> int or None:
+        index = int(song_id) - 100000 if song_id.isdigit() else -1
+        return index if 0 <= index < self.songs else None
+
+    def album_of(self, album_id: str) -> int or None:
+        album = int(album_id) - 1000 if album_id.isdigit() else -1
+        return album if 0 <= album * self.album_size < self.songs else None
+
+    def album_tracks(self, album: int) -> range:
+        return range(album * self.album_size, min((album + 1) * self.album_size, self.songs))
+
+    def album_url(self, album: int) -> str:
+        return f"{self.base_url}/am/il/album/album-{album}/{self.album_id(album)}"
+
+    def song_url(self, index: int) -> str:
+        return f"{self.album_url(index // self.album_size)}?i={self.song_id(index)}"
+
+    def playlist_url(self) -> str:
+        return f"{self.base_url}/am/il/playlist/benchmark/{PLAYLIST_ID}"
+
+    def artwork(self, album: int) -> dict:
+        return {'url': f"{self.base_url}/artwork/{album}/{{w}}x{{h}}bb.{{f}}"}
+
+    def song(self, index: int) -> dict:
+        album = index // self.album_size
+        return {
+            'id': self.song_id(index),
+            'type': 'songs',
+            'attributes': {
+                'name': f"Song {index}",
+                'artistName': f"Artist {album % 50}",
+                'albumName': f"Album {album}",
+                'artwork': self.artwork(album),
+                'contentRating': 'explicit' if index % 7 == 0 else None,
+                'genreNames': ['Pop', 'Music'],
+                'releaseDate': '2020-01-01',
+                'url': self.song_url(index),
+                'discNumber': 1,
+                'isrc': self.isrc(index),
+                'trackNumber': index % self.album_size + 1
+            }
+        }
+
+    def album(self, album: int) -> dict:
+        tracks = self.album_tracks(album)
+        return {
+            'id': self.album_id(album),
+            'type': 'albums',
+            'attributes': {
+                'name': f"Album {album}",
+                'artistName': f"Artist {album % 50}",
+                'artwork': self.artwork(album),
+                'genreNames': ['Pop', 'Music'],
+                'releaseDate': '2020-01-01',
+                'url': self.album_url(album),
+                'copyright': f"℗ 2020 Label {album}",
+                'recordLabel': f"Label {album}",
+                'trackCount': len(tracks)
+            },
+            'relationships': {'tracks': {'data': [self.song(index) for index in tracks]}}
+        }
+
+    def tracks_page(self, offset: int, size: int = PAGE_SIZE) -> dict:
+        page = {'data': [self.song(index) for index in range(offset, min(offset + size, self.songs))]}
+        if offset + size < self.songs:
+            page['next'] = f"/v1/catalog/il/playlists/{PLAYLIST_ID}/tracks?offset={offset + size}"
+        return page
+
+    def playlist(self, tracks: int = PAGE_SIZE) -> dict:
+        first_page = self.tracks_page(0, tracks)
+        return {
+            'id': PLAYLIST_ID,
+            'type': 'playlists',
+            'attributes': {'name': 'Benchmark', 'url': self.playlist_url()},
+            'relationships': {'tracks': first_page}
+        }
+
+    def itunes_results(self, song_ids: list) -> list:
+        results = []
+        albums = set()
+        for song_id in song_ids:
+            index = self.index_of(song_id)
+            if index is None:
+                continue
+            album = index // self.album_size
+            results.append({
+                'wrapperType': 'track',
+                'trackId': int(song_id),
+                'collectionId': int(self.album_id(album)),
+                'primaryGenreName': 'Pop',
+                'trackNumber': index % self.album_size + 1,
+                'trackCount': len(self.album_tracks(album)),
+                'discNumber': 1,
+                'discCount': 1
+            })
+            if album not in albums:
+                albums.add(album)
+                results.append({
+                    'wrapperType': 'collection',
+                    'collectionId': int(self.album_id(album)),
+                    'artistName': f"Artist {album % 50}",
+                    'copyright': f"℗ 2020 Label {album}",
+                    'trackCount': len(self.album_tracks(album))
+                })
+        return results
+
+
+class FakeUpstream(ThreadingHTTPServer):
+    """
+    An HTTP server standing in for every upstream service, under its own path prefix.
+    Every request waits 'latency' seconds (media downloads wait 'media_latency' seconds),
+    and requests of the 'error_services' fail with a 503 (asking to retry right away) at the
+    given 'error_rate'. Requests are counted per service.
+    The playlist page embeds its first 'page_tracks' tracks, and every Apple Music page has
+    another shoebox entry of 'page_padding' bytes before the item's entry (as real pages do).
+    """
+    daemon_threads = True
+
+    def __init__(self, songs: int, album_size: int = 10, song_size: int = 4 * 1024 * 1024,
+                 artwork_size: int = 200 * 1024, latency: float = 0.0, media_latency: float = 0.0,
+                 error_rate: float = 0.0, error_services: tuple = METADATA_SERVICES, seed: int = 0,
+                 page_tracks: int = PAGE_SIZE, page_padding: int = 0):
+        super().__init__(('127.0.0.1', 0), UpstreamHandler)
+        self.base_url = f"http://127.0.0.1:{self.server_port}"
+        self.catalog = Catalog(self.base_url, songs, album_size)
+        self.mp3 = synthetic_mp3(song_size)
+        self.artwork = JPEG_HEADER + bytes(max(artwork_size - len(JPEG_HEADER), 0))
+        self.latency = latency
+        self.media_latency = media_latency
+        self.error_rate = error_rate
+        self.error_services = set(error_services)
+        self.page_tracks = page_tracks
+        self.page_padding = page_padding
+        self.requests = Counter()
+        self.injected_errors = Counter()
+        self.uploaded_bytes = 0
+        self.transfers = set()
+        self.csrf_token = 'benchmark-csrf'
+        self._random = Random(seed)
+        self._lock = Lock()
+        self._ids = Counter()
+        self._pages = {}
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def should_fail(self, service: str) -> bool:
+        with self._lock:
+            self.requests[service] += 1
+            failed = service in self.error_services and self._random.random() < self.error_rate
+            if failed:
+                self.injected_errors[service] += 1
+            return failed
+
+    def page(self, path: str, render) -> bytes:
+        """
+        Returns the html page of the given path, rendering it (with the given function) only once.
+        """
+        with self._lock:
+            if path not in self._pages:
+                self._pages[path] = render()
+            return self._pages[path]
+
+    def next_id(self, kind: str) -> str:
+        with self._lock:
+            self._ids[kind] += 1
+            return f"{kind}{self._ids[kind]}"
+
+    def add_uploaded(self, size: int):
+        with self._lock:
+            self.uploaded_bytes += size
+
+    def expire_csrf_token(self):
+        """
+        Replaces the WeTransfer CSRF token - requests with the former one are then answered with a 403.
+        """
+        with self._lock:
+            self._ids['csrf'] += 1
+            self.csrf_token = f"benchmark-csrf{self._ids['csrf']}"
+
+    def expire_transfers(self):
+        """
+        Makes every WeTransfer transfer created so far expire - its requests are then answered with a 404.
+        """
+        with self._lock:
+            self.transfers.clear()
+
+
+def point_wetransfer_at(base_url: str):
+    """
+    Points segevmusic's WeTransfer urls at the fake upstream of the given base url.
+    """
+    from segevmusic import wetransfer
+    wetransfer.WETRANSFER_URL = base_url + '/wetransfer/'
+    wetransfer.WETRANSFER_API_URL = wetransfer.WETRANSFER_URL + 'api/v4/transfers'
+    wetransfer.WETRANSFER_UPLOAD_LINK_URL = wetransfer.WETRANSFER_API_URL + '/link'
+    wetransfer.WETRANSFER_FILES_URL = wetransfer.WETRANSFER_API_URL + '/{transfer_id}/files'
+    wetransfer.WETRANSFER_PART_PUT_URL = wetransfer.WETRANSFER_FILES_URL + '/{file_id}/part-put-url'
+    wetransfer.WETRANSFER_FINALIZE_MPP_URL = wetransfer.WETRANSFER_FILES_URL + '/{file_id}/finalize-mpp'
+    wetransfer.WETRANSFER_FINALIZE_URL = wetransfer.WETRANSFER_API_URL + '/{transfer_id}/finalize'
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ROUTES = [
+        ('GET', re.compile(r'/am/il/album/[^/]+/(\d+)$'), 'apple-music', 'album_page'),
+        ('GET', re.compile(r'/am/il/playlist/[^/]+/([^/]+)$'), 'apple-music', 'playlist_page'),
+        ('GET', re.compile(r'/amp/v1/catalog/il/playlists/[^/]+/tracks$'), 'apple-music-api', 'tracks_page'),
+        ('GET', re.compile(r'/search$'), 'apple-search', 'search'),
+        ('GET', re.compile(r'/itunes/lookup$'), 'itunes', 'itunes_lookup'),
+        ('GET', re.compile(r'/artwork/(\d+)/'), 'artwork', 'artwork'),
+        ('GET', re.compile(r'/odesli/links$'), 'odesli', 'odesli'),
+        ('GET', re.compile(r'/deezer/2\.0/track/isrc:(\w+)$'), 'deezer-api', 'deezer_track'),
+        ('GET', re.compile(r'/deezer/media/(\d+)$'), 'deezer-media', 'deezer_media'),
+        ('GET', re.compile(r'/wetransfer/$'), 'wetransfer', 'wetransfer_home'),
+        ('POST', re.compile(r'/wetransfer/api/v4/transfers/link$'), 'wetransfer', 'wetransfer_create'),
+        ('POST', re.compile(r'/wetransfer/api/v4/transfers/([^/]+)/files$'), 'wetransfer', 'wetransfer_file'),
+        ('POST', re.compile(r'/wetransfer/api/v4/transfers/([^/]+)/files/[^/]+/part-put-url$'), 'wetransfer',
+         'wetransfer_part_url'),
+        ('PUT', re.compile(r'/wetransfer/parts/'), 'wetransfer-parts', 'wetransfer_part'),
+        ('PUT', re.compile(r'/wetransfer/api/v4/transfers/([^/]+)/files/[^/]+/finalize-mpp$'), 'wetransfer',
+         'wetransfer_empty'),
+        ('PUT', re.compile(r'/wetransfer/api/v4/transfers/([^/]+)/finalize$'), 'wetransfer', 'wetransfer_finalize')
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def do_OPTIONS(self):
+        self.reply(b'', 'text/plain')
+
+    def route(self, method: str):
+        parts = urlsplit(self.path)
+        self.query = parse_qs(parts.query)
+        self.body = self.read_body(parts.path.startswith('/wetransfer/parts/'))
+        for route_method, pattern, service, handler in self.ROUTES:
+            match = pattern.match(parts.path)
+            if route_method != method or not match:
+                continue
+            sleep(self.server.media_latency if service == 'deezer-media' else self.server.latency)
+            if self.server.should_fail(service):
+                self.reply(b'', status=503, headers={'Retry-After': '0'})
+                return None
+            if service == 'wetransfer' and handler != 'wetransfer_home' and \
+                    self.headers.get('x-csrf-token') != self.server.csrf_token:
+                self.reply(b'{"message": "invalid csrf token"}', status=403)
+                return None
+            getattr(self, handler)(*match.groups())
+            return None
+        self.reply(b'not found', status=404)
+
+    def read_body(self, drain: bool = False) -> bytes or int:
+        """
+        Returns the request's body, or only its size if it should be drained
+        (so uploaded parts are never held in memory).
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        if not drain:
+            return self.rfile.read(length)
+        left = length
+        while left:
+            left -= len(self.rfile.read(min(left, DRAIN_CHUNK_SIZE))) or left
+        return length
+
+    def reply(self, body: bytes, content_type: str = 'application/json', status: int = 200, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, json):
+        self.reply(dumps(json).encode())
+
+    def reply_page(self, item, head: str = ''):
+        """
+        Replies with the html page of an item (given as a function returning it), which is rendered once.
+        """
+        def render():
+            meta = dumps({'padding': 'x' * self.server.page_padding})
+            shoebox = dumps({'meta': meta, 'item': dumps({'d': [item()]})})
+            return f"<html><head>{head}</head><body>{SHOEBOX_START}{shoebox}</script></body></html>".encode()
+        self.reply(self.server.page(urlsplit(self.path).path, render), 'text/html')
+
+    @property
+    def catalog(self) -> Catalog:
+        return self.server.catalog
+
+    def album_page(self, album_id: str):
+        album = self.catalog.album_of(album_id)
+        if album is None:
+            self.reply(b'', status=404)
+            return None
+        self.reply_page(lambda: self.catalog.album(album))
+
+    def playlist_page(self, playlist_id: str):
+        environment = quote(dumps({'MEDIA_API': {'token': MEDIA_API_TOKEN}}))
+        self.reply_page(lambda: self.catalog.playlist(self.server.page_tracks),
+                        ENVIRONMENT_META.format(content=environment))
+
+    def tracks_page(self):
+        if self.headers.get('Authorization') != f"Bearer {MEDIA_API_TOKEN}":
+            self.reply(b'', status=401)
+            return None
+        self.reply_json(self.catalog.tracks_page(int(self.query.get('offset', ['0'])[0])))
+
+    def search(self):
+        term = self.query.get('term', [''])[0]
+        index = int(term.split()[1]) if term.startswith('Song ') else None
+        songs = [self.catalog.song(index)] if index is not None and index < self.catalog.songs else []
+        self.reply_json({'songs': {'data': songs}, 'albums': {'data': []}})
+
+    def itunes_lookup(self):
+        song_ids = self.query.get('id', [''])[0].split(',')
+        results = self.catalog.itunes_results(song_ids)
+        self.reply_json({'resultCount': len(results), 'results': results})
+
+    def artwork(self, album: str):
+        self.reply(self.server.artwork, 'image/jpeg')
+
+    def odesli(self):
+        index = self.query.get('url', [''])[0].rsplit('/', 1)[-1]
+        index = int(index) if index.isdigit() else -1
+        if not 0 <= index < self.catalog.songs:
+            self.reply_json({'linksByPlatform': {}})
+            return None
+        self.reply_json({'linksByPlatform': {'appleMusic': {'url': self.catalog.song_url(index)}}})
+
+    def deezer_track(self, isrc: str):
+        index = int(isrc[len('BENCH'):]) if isrc.startswith('BENCH') else -1
+        if not 0 <= index < self.catalog.songs:
+            self.reply_json({'error': {'code': 800, 'message': 'no data'}})
+            return None
+        self.reply_json({'id': int(self.catalog.song_id(index)), 'isrc': isrc})
+
+    def deezer_media(self, track_id: str):
+        index = self.catalog.index_of(track_id)
+        if index is None:
+            self.reply(b'', status=404)
+            return None
+        self.reply(self.server.mp3, 'audio/mpeg', headers={'X-ISRC': self.catalog.isrc(index)})
+
+    def wetransfer_home(self):
+        self.reply(f'<meta name="csrf-token" content="{self.server.csrf_token}">'.encode(), 'text/html')
+
+    def transfer_expired(self, transfer_id: str) -> bool:
+        if transfer_id in self.server.transfers:
+            return False
+        self.reply(b'{"message": "transfer not found"}', status=404)
+        return True
+
+    def wetransfer_create(self):
+        transfer_id = self.server.next_id('transfer')
+        self.server.transfers.add(transfer_id)
+        self.reply_json({'id': transfer_id})
+
+    def wetransfer_file(self, transfer_id: str):
+        if not self.transfer_expired(transfer_id):
+            self.reply_json({'id': self.server.next_id('file')})
+
+    def wetransfer_part_url(self, transfer_id: str):
+        if not self.transfer_expired(transfer_id):
+            self.reply_json({'url': f"{self.server.base_url}/wetransfer/parts/{self.server.next_id('part')}"})
+
+    def wetransfer_part(self):
+        self.server.add_uploaded(self.body)
+        self.reply(b'', 'text/plain')
+
+    def wetransfer_empty(self, transfer_id: str):
+        if not self.transfer_expired(transfer_id):
+            self.reply_json({})
+
+    def wetransfer_finalize(self, transfer_id: str):
+        if self.transfer_expired(transfer_id):
+            return None
+        self.reply_json({'shortened_url': f"{self.server.base_url}/wetransfer/{transfer_id}"})
+
+
+class StubDownloadObject:
+    """
+    Stands in for deemix's download object of a single track link.
+    """
+
+    def __init__(self, link: str):
+        self.link = link
+        self.downloaded = 0
+        self.failed = 0
+
+
+class StubDownloader:
+    """
+    Stands in for deemix's Downloader - downloads the track's mp3 from the fake Deezer media
+    endpoint into the download location, named by the settings' track name template.
+    """
+    media_url = None
+
+    def __init__(self, app, download_object: StubDownloadObject, settings: dict, listener=None):
+        self.download_object = download_object
+        self.settings = settings
+
+    def start(self):
+        from segevmusic.transport import session
+        track_id = self.download_object.link.rstrip('/').rsplit('/', 1)[-1]
+        response = session().get(f"{self.media_url}/{track_id}")
+        if not response.ok:
+            self.download_object.failed = 1
+            return None
+        name = self.settings['tracknameTemplate'].replace('%isrc%', response.headers['X-ISRC'])
+        with open(f"{self.settings['downloadLocation']}/{name}.mp3", 'wb') as f:
+            f.write(response.content)
+        self.download_object.downloaded = 1
+
+
+def generate_download_object(app, link: str, bitrate, plugins: dict, listener=None) -> StubDownloadObject:
+    """
+    Stands in for deemix's generateDownloadObject.
+    """
+    return StubDownloadObject(link)
+
+
+def generate_track_item(app, link_id, bitrate, trackAPI: dict = None, albumAPI: dict = None) -> StubDownloadObject:
+    """
+    Stands in for deemix's generateTrackItem.
+    """
+    return StubDownloadObject(f"https://www.deezer.com/track/{link_id}")
+
+
+class StubDeezerApp:
+    """
+    Stands in for a logged in Deezer session - only its deemix settings are used.
+    """
+
+    def __init__(self, download_path: str, queue_concurrency: int = 3):
+        from segevmusic.overriders import DEFAULT_DEEMIX_SETTINGS
+        from copy import deepcopy
+        self.settings = deepcopy(DEFAULT_DEEMIX_SETTINGS)
+        self.settings['downloadLocation'] = download_path
+        self.settings['queueConcurrency'] = queue_concurrency
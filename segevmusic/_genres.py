@@ -1,3 +1,10 @@
+from segevmusic.cache import CACHE_DIR
+from threading import Lock
+from os import makedirs, replace, getpid
+from os.path import join, dirname
+from json import load, dump
+
+GENRES_STORE_PATH = join(CACHE_DIR, 'genres.json')
 GENRES_TRANSLATION = {
     "אינדי": "Indie",
     "אינדי הודי": "Indian Independent",
@@ -115,3 +122,52 @@ GENRES_TRANSLATION = {
     "תחושה טובה": "Feel Good",
     "תחושת עצבות": "Feeling Blue"
 }
+
+
+class GenresStore:
+    """
+    Hebrew to English genre translations - the known ones above, and ones learned from lookups,
+    which are kept in a json file. The file is loaded only when a translation is first needed,
+    and is merged with its current content whenever a translation is added.
+    """
+
+    def __init__(self, path: str = GENRES_STORE_PATH, known: dict = None):
+        self.path = path
+        self.known = GENRES_TRANSLATION if known is None else known
+        self._translations = None
+        self._lock = Lock()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                saved = load(f)
+        except (OSError, ValueError):
+            return {}
+        return saved if isinstance(saved, dict) else {}
+
+    @property
+    def translations(self) -> dict:
+        with self._lock:
+            if self._translations is None:
+                self._translations = dict(self.known, **self._read())
+            return self._translations
+
+    def get(self, genre: str) -> str or None:
+        return self.translations.get(genre)
+
+    def set(self, genre: str, translation: str):
+        """
+        Adds a translation, and saves it along with the ones saved meanwhile by other runs.
+        """
+        translations = self.translations
+        with self._lock:
+            translations[genre] = translation
+            saved = dict(self._read(), **{genre: translation})
+            makedirs(dirname(self.path), exist_ok=True)
+            temp_path = f"{self.path}.{getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                dump(saved, f, ensure_ascii=False, indent=2)
+            replace(temp_path, self.path)
+
+
+GENRES_STORE = GenresStore()
@@ -1,14 +1,26 @@
-from segevmusic.utils import get_language, choose_item, update_url_param, has_hebrew, get_url_param_value
-from segevmusic._genres import GENRES_TRANSLATION
-from requests import get
-from typing import List
-from urllib.parse import quote
-from re import search
-from json import loads
+from segevmusic.utils import get_language, choose_item, update_url_param, has_hebrew, get_url_param_value, \
+    remove_url_param, safe_print
+from segevmusic._genres import GENRES_STORE
+from segevmusic.fetcher import get, get_content_between, get_json, HOST_CONCURRENCY
+from segevmusic.cache import ResponseCache, CACHE_DIR
+from segevmusic.profiler import PROFILER, timed
+from typing import List, Iterable, Iterator, Tuple
+from threading import Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from os.path import join
+from urllib.parse import quote, unquote
+from re import compile
+from json import loads, JSONDecoder
+from json.decoder import scanstring
 
 ARTWORK_EMBED_SIZE = 1400
 ARTWORK_REPR_SIZE = 600
 ARTWORK_FORMAT = 'jpg'
+ARTWORK_MEMORY_CACHE_SIZE = 64
+ARTWORK_DISK_CACHE_SIZE = 512 * 1024 * 1024
+ARTWORK_DISK_CACHE_TTL = 90 * 24 * 60 * 60
+ARTWORK_CACHE_PATH = join(CACHE_DIR, 'artwork.sqlite')
 AMOBJECT_REPR_FIRST = "Name: {name} // Artist: {artist_name} "
 AMOBJECT_REPR_SECOND = "({release_date}){explicit}"
 AMSONG_REPR_MIDDLE = " // Album: {album_name} "
@@ -16,67 +28,245 @@ AM_QUERY = r"https://tools.applemediaservices.com/api/apple-media/music/IL/" \
            r"search.json?types=songs,albums&term={name}&limit={limit}&l={language}"
 ITUNES_SONG_QUERY = 'https://itunes.apple.com/il/lookup?id={id}&entity=song&l={language}'
 ITUNES_ALBUM_QUERY = 'https://itunes.apple.com/il/lookup?id={id}&entity=album&l={language}'
+ITUNES_GENRE_QUERY = 'https://itunes.apple.com/il/lookup?id={id}&l=en'
+GENRE_LOOKUP_WORKERS = 4
+ITUNES_BATCH_SIZE = 150
+ITUNES_BATCH_WORKERS = 4
+ALBUM_FETCH_WORKERS = 8
+ITUNES_BATCH_RETRIES = 2
 AM_DOMAIN = 'apple.com'
-AM_REGEX = b'<script type="fastboot/shoebox" id="shoebox-media-api-cache-amp-music">(.*?)</script>'
+AM_SHOEBOX_START = b'<script type="fastboot/shoebox" id="shoebox-media-api-cache-amp-music">'
+AM_SHOEBOX_END = b'</script>'
+AM_SHOEBOX_ENTRY = 1
+JSON_WHITESPACE_REGEX = compile(r'[ \t\n\r]*')
+JSON_SEPARATOR_REGEX = compile(r'[:,]')
 AM_LANGUAGE_PARAM = 'l'
+AM_API_URL = 'https://amp-api.music.apple.com'
+AM_ORIGIN = 'https://music.apple.com'
+AM_ENVIRONMENT_START = b'<meta name="desktop-music-app/config/environment" content="'
+AM_ENVIRONMENT_END = b'"'
+AM_DEFAULT_LANGUAGE = 'he'
+AM_SONG_INDEX_PARAM = 'i'
 
 SONG_SEARCH_LIMIT = 1
 ALBUM_SEARCH_LIMIT = 5
+KEEP_RAW_JSON = False
+
+MISSING = object()
+
+
+def _extract(json: dict, path: tuple):
+    """
+    Returns the value found in the given path of keys inside the json,
+    or MISSING if the path doesn't exist.
+    """
+    value = json
+    try:
+        for key in path:
+            value = value[key]
+    except (KeyError, IndexError, TypeError):
+        return MISSING
+    return value
+
+
+class ArtworkCache:
+    """
+    A cache of artworks bytes, keyed by the artwork's url template, size and format.
+    Recently used artworks are kept in memory, and optionally on disk across runs.
+    Concurrent requests for the same artwork wait for a single download.
+    """
+
+    def __init__(self, disk_path: str = ARTWORK_CACHE_PATH, use_disk: bool = True,
+                 memory_size: int = ARTWORK_MEMORY_CACHE_SIZE, disk_size: int = ARTWORK_DISK_CACHE_SIZE):
+        self.memory = OrderedDict()
+        self.memory_size = memory_size
+        self.disk = ResponseCache(disk_path, disk_size)
+        self.use_disk = use_disk
+        self._locks = {}
+        self._lock = Lock()
+        self._executor = None
+        self._prefetches = {}
+
+    @staticmethod
+    def _url(template: str, w: int, h: int, f: str) -> str:
+        if '{f}' in template:
+            return template.format(w=w, h=h, f=f)
+        return template.format(w=w, h=h)
+
+    def _remember(self, key: str, artwork: bytes):
+        with self._lock:
+            self.memory[key] = artwork
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    @staticmethod
+    @timed('artwork_fetch')
+    def _download(url: str) -> bytes:
+        """
+        Returns the artwork of a given url, or raises an HTTPError if it couldn't be downloaded
+        (so error pages are never cached as artworks).
+        """
+        PROFILER.count('artwork_downloads')
+        response = get(url)
+        response.raise_for_status()
+        return response.content
+
+    def get(self, template: str, w: int, h: int, f: str) -> bytes:
+        """
+        Returns the bytes of the artwork of the given url template, size and format,
+        downloading it only if it isn't cached.
+        """
+        key = f"{template} {w}x{h} {f}"
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            key_lock = self._locks.setdefault(key, Lock())
+        with key_lock:
+            if key in self.memory:
+                return self.memory[key]
+            artwork = self.disk.get(key) if self.use_disk else None
+            if artwork is None:
+                artwork = self._download(self._url(template, w, h, f))
+                if self.use_disk:
+                    self.disk.set(key, artwork, ARTWORK_DISK_CACHE_TTL)
+            self._remember(key, artwork)
+        with self._lock:
+            self._locks.pop(key, None)
+        return artwork
+
+    def prefetch(self, songs: Iterable):
+        """
+        Starts downloading the embedded artworks of the given songs in the background
+        (see 'wait_prefetch' and 'shutdown').
+        """
+        with self._lock:
+            if not self._executor:
+                self._executor = ThreadPoolExecutor(max_workers=HOST_CONCURRENCY)
+            for song in songs:
+                self._prefetches[song] = self._executor.submit(self._prefetch_song, song)
+
+    def wait_prefetch(self, song):
+        """
+        Waits for the running prefetch of a given song's artwork, so the artwork is then taken from the
+        cache rather than downloaded again. A prefetch that didn't start yet is cancelled instead, as the
+        artwork is about to be fetched anyway.
+        """
+        with self._lock:
+            prefetch = self._prefetches.pop(song, None)
+        if prefetch and not prefetch.cancel():
+            prefetch.result()
+
+    def shutdown(self):
+        """
+        Cancels the prefetches that didn't start yet, and lets the running ones end without waiting
+        for them - so exiting (or failing) doesn't wait for every queued artwork.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            prefetches, self._prefetches = self._prefetches, {}
+        for prefetch in prefetches.values():
+            prefetch.cancel()
+        if executor:
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _prefetch_song(song):
+        try:
+            song.get_artwork(prefer_album=True)
+        except Exception:
+            pass
+
+
+ARTWORK_CACHE = ArtworkCache()
 
 
 class AMObject:
     """
     A class for handling Apple Music API's mutual attributes for
     Songs and Album objects.
+    Only the fields listed in FIELDS are kept - the raw json is kept only if asked to.
     """
-
-    def __init__(self, json=None, translate=True):
-        self.json = json
+    FIELDS = {
+        '_id': ('id',),
+        '_artist_name': ('attributes', 'artistName'),
+        '_album_name': ('attributes', 'albumName'),
+        '_artwork_url': ('attributes', 'artwork', 'url'),
+        '_content_rating': ('attributes', 'contentRating'),
+        '_genres': ('attributes', 'genreNames'),
+        '_name': ('attributes', 'name'),
+        '_release_date': ('attributes', 'releaseDate'),
+        '_url': ('attributes', 'url')
+    }
+    __slots__ = tuple(FIELDS) + ('_json', '_exists', 'language')
+
+    def __init__(self, json=None, translate=True, keep_json=None):
+        if keep_json is None:
+            keep_json = KEEP_RAW_JSON
+        for slot, path in self.FIELDS.items():
+            setattr(self, slot, _extract(json, path))
+        self._json = json if keep_json else None
+        self._exists = bool(json)
         self.language = None
         if self and translate:
             AMFunctions.translate_item(self)
 
+    def _field(self, slot: str):
+        """
+        Returns the value of the given field, raising KeyError if it was missing in the json.
+        """
+        value = getattr(self, slot)
+        if value is MISSING:
+            raise KeyError(self.FIELDS[slot][-1])
+        return value
+
+    @property
+    def json(self):
+        """
+        The raw json of the object, if it was kept.
+        """
+        return self._json
+
     @property
     def id(self):
-        return self.json['id']
+        return self._field('_id')
 
     @property
     def artist_name(self):
-        return self.json['attributes']['artistName']
+        return self._field('_artist_name')
 
     @property
     def album_name(self):
-        return self.json['attributes']['albumName']
+        return self._field('_album_name')
 
     @property
     def artwork_url(self):
-        return self.json['attributes']['artwork']['url']
+        return self._field('_artwork_url')
 
     @property
     def is_explicit(self) -> bool:
-        if 'contentRating' in self.json['attributes']:
-            return self.json['attributes']['contentRating'] == 'explicit'
-        return False
+        return self._content_rating == 'explicit'
 
     @property
     def genres(self):
-        return self.json['attributes']['genreNames']
+        return self._field('_genres')
 
     @genres.setter
     def genres(self, value):
-        self.json['attributes']['genreNames'] = value
+        self._genres = value
 
     @property
     def name(self):
-        return self.json['attributes']['name']
+        return self._field('_name')
 
     @property
     def release_date(self):
-        return self.json['attributes']['releaseDate']
+        return self._field('_release_date')
 
     @property
     def url(self):
-        return self.json['attributes']['url']
+        return self._field('_url')
 
     @property
     def short_name(self):
@@ -86,17 +276,14 @@ class AMObject:
         """
         Returns the bytes of the artwork, with the given width and height.
         """
-        url = self.artwork_url
-        if '{f}' in url:
-            return get(url.format(w=w, h=h, f=f)).content
-        return get(url.format(w=w, h=h)).content
+        return ARTWORK_CACHE.get(self.artwork_url, w, h, f)
 
     def _str_part_two(self):
         return AMOBJECT_REPR_SECOND.format(release_date=self.release_date,
                                            explicit=" *Explicit*" if self.is_explicit else '')
 
     def __bool__(self):
-        return bool(self.json)
+        return self._exists
 
     def __str__(self):
         return AMOBJECT_REPR_FIRST.format(name=self.name, artist_name=self.artist_name, album_name=self.album_name)
@@ -109,43 +296,52 @@ class AMSong(AMObject):
     """
     A class for handling Apple Music API's Song object.
     """
-
-    def __init__(self, json=None, album=None, add_album=True, translate=True):
-        super().__init__(json, translate)
+    FIELDS = dict(AMObject.FIELDS, **{
+        '_disc_number': ('attributes', 'discNumber'),
+        '_isrc': ('attributes', 'isrc'),
+        '_track_number': ('attributes', 'trackNumber'),
+        '_preview': ('attributes', 'previews', 0, 'url')
+    })
+    __slots__ = tuple(slot for slot in FIELDS if slot not in AMObject.FIELDS) + ('album',)
+
+    def __init__(self, json=None, album=None, add_album=True, translate=True, keep_json=None):
+        super().__init__(json, False, keep_json)
         self.album = album
+        translating = AMFunctions.start_translating(self) if self and translate else None
         if (self and add_album) and not album:
             AMFunctions.attach_album(self)
+        AMFunctions.finish_translating(self, translating)
 
     @property
     def disc_number(self):
-        return self.json['attributes']['discNumber']
+        return self._field('_disc_number')
 
     @disc_number.setter
     def disc_number(self, value):
-        self.json['attributes']['discNumber'] = value
+        self._disc_number = value
 
     @property
     def isrc(self):
-        return self.json['attributes']['isrc']
+        return self._field('_isrc')
 
     @isrc.setter
     def isrc(self, value: str):
-        self.json['attributes']['isrc'] = value
+        self._isrc = value
 
     @property
     def track_number(self):
-        return self.json['attributes']['trackNumber']
+        return self._field('_track_number')
 
     @track_number.setter
     def track_number(self, value):
-        self.json['attributes']['trackNumber'] = value
+        self._track_number = value
 
     @property
     def preview(self):
         """
         Returns the link for the song's audio preview.
         """
-        return self.json['attributes']['previews'][0]['url']
+        return self._field('_preview')
 
     def album_id_from_song_url(self) -> str:
         """
@@ -175,11 +371,20 @@ class AMSong(AMObject):
 class AMAlbum(AMObject):
     """
     A class for handling Apple Music API's Album object.
+    The album's tracks json is kept only until its songs are created.
     """
-
-    def __init__(self, json=None):
-        super().__init__(json)
+    FIELDS = dict(AMObject.FIELDS, **{
+        '_copyright': ('attributes', 'copyright'),
+        '_record_label': ('attributes', 'recordLabel'),
+        '_track_count': ('attributes', 'trackCount'),
+        '_tracks': ('relationships', 'tracks', 'data')
+    })
+    __slots__ = tuple(slot for slot in FIELDS if slot not in AMObject.FIELDS) + ('found_songs', '_songs_index')
+
+    def __init__(self, json=None, keep_json=None):
+        super().__init__(json, keep_json=keep_json)
         self.found_songs = []
+        self._songs_index = {}
 
     @property
     def album_name(self):
@@ -187,32 +392,47 @@ class AMAlbum(AMObject):
 
     @property
     def copyright(self):
-        if 'copyright' in self.json['attributes']:
-            return self.json['attributes']['copyright']
-        return None
+        return self._copyright if self._copyright is not MISSING else None
 
     @property
     def record_label(self):
-        return self.json['attributes']['recordLabel']
+        return self._field('_record_label')
 
     @property
     def track_count(self):
-        return self.json['attributes']['trackCount']
+        return self._field('_track_count')
 
     @track_count.setter
     def track_count(self, value):
-        self.json['attributes']['trackCount'] = value
+        self._track_count = value
 
     @property
     def songs(self) -> List[AMSong]:
-        if not self.found_songs:
-            for track in self.json['relationships']['tracks']['data']:
+        if not self.found_songs and self._tracks is not None:
+            for track in self._field('_tracks'):
                 if track['type'] == 'songs':
                     song = AMSong(track, self, translate=False)
                     song.genres = self.genres
                     self.found_songs.append(song)
+            self._tracks = None
         return self.found_songs
 
+    @property
+    def songs_index(self) -> dict:
+        """
+        The album's songs, by their id.
+        """
+        if not self._songs_index:
+            self._songs_index = {song.id: song for song in self.songs}
+        return self._songs_index
+
+    def discard_tracks(self):
+        """
+        Drops the album's tracks json, for albums that are kept only for their own metadata.
+        """
+        if not self.found_songs:
+            self._tracks = None
+
     def __iter__(self):
         for song in self.songs:
             yield song
@@ -221,27 +441,56 @@ class AMAlbum(AMObject):
         return "Album " + super(AMAlbum, self).__str__() + super(AMAlbum, self)._str_part_two()
 
     def __getitem__(self, item):
-        for song in self.songs:
-            if song.id == item:
-                return song
-        raise IndexError(f"The id {item} was not found in this album.")
+        if item not in self.songs_index:
+            raise IndexError(f"The id {item} was not found in this album.")
+        return self.songs_index[item]
 
 
 class AMPlaylist:
+    __slots__ = ('_tracks', '_next', '_url', 'found_songs')
+
     def __init__(self, json=None):
-        self.json = json
+        self._tracks = _extract(json, ('relationships', 'tracks', 'data'))
+        self._next = _extract(json, ('relationships', 'tracks', 'next'))
+        self._url = _extract(json, ('attributes', 'url'))
         self.found_songs = []
 
     @property
     def songs(self) -> List[AMSong]:
-        if not self.found_songs:
-            for track in self.json['relationships']['tracks']['data']:
-                if track['type'] == 'songs':
-                    song = AMSong(track, add_album=False)
-                    self.found_songs.append(song)
-            AMFunctions.update_metadata(self, add_album=True)
+        for _ in self.iter_batches():
+            pass
         return self.found_songs
 
+    def iter_batches(self, language: str = AM_DEFAULT_LANGUAGE) -> Iterator[List[AMSong]]:
+        """
+        Yields the playlist's songs page by page, following the tracks pagination past the page
+        embedded in the playlist's html. Every batch already has its metadata (albums, track and
+        disc numbers) filled in, and the next page is fetched while the current one is handled.
+        The yielded songs are kept in 'found_songs'.
+        """
+        if self._tracks is MISSING:
+            if self.found_songs:
+                yield self.found_songs
+            return None
+        tracks, next_page = self._tracks, self._next
+        self._tracks = MISSING
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                next_tracks = None
+                if next_page is not MISSING and next_page and self._url is not MISSING:
+                    next_tracks = executor.submit(AMFunctions.get_tracks_page, next_page, self._url, language)
+                batch = [AMSong(track, add_album=False) for track in tracks if track['type'] == 'songs']
+                batch = AMFunctions.update_metadata(batch, add_album=True)
+                self.found_songs += batch
+                yield batch
+                if not next_tracks:
+                    break
+                try:
+                    tracks, next_page = next_tracks.result()
+                except Exception as e:
+                    safe_print(f"--> ERROR: Couldn't load the rest of the playlist: {e}")
+                    break
+
     def __iter__(self):
         for song in self.songs:
             yield song
@@ -256,8 +505,17 @@ class AMFunctions:
         'songs': AMSong,
         'playlists': AMPlaylist
     }
+    _albums = {}
+    _albums_locks = {}
+    _albums_lock = Lock()
+    _genre_lookups = {}
+    _genre_lookups_lock = Lock()
+    _genre_lookups_executor = None
+    _media_api_token = None
+    _media_api_token_lock = Lock()
 
     @staticmethod
+    @timed('search')
     def query(name: str, limit: int) -> dict:
         """
         Query Apple Music with the given string, search limit and response language.
@@ -265,15 +523,15 @@ class AMFunctions:
         """
         encoded_name = quote(name)
         query = AM_QUERY.format(name=encoded_name, limit=limit, language=get_language(name))
-        json = get(query).json()
+        json = get_json(query)
         return json
 
     @staticmethod
-    def json_to_items(json: dict, items_type: type) -> List[AMObject]:
+    def json_to_items(json: dict, items_type: type, **kwargs) -> List[AMObject]:
         if not json:
             return []
         item_key = 'songs' if items_type == AMSong else 'albums'
-        items = [items_type(song_json) for song_json in json[item_key]['data']]
+        items = [items_type(song_json, **kwargs) for song_json in json[item_key]['data']]
         return items
 
     @classmethod
@@ -296,53 +554,229 @@ class AMFunctions:
             return chosen_item
 
     @classmethod
+    def reset_registries(cls):
+        """
+        Forgets the albums, genre lookups and API token kept so far, so a long-running
+        process (the job server) doesn't keep them forever.
+        Translated genres and cached responses are kept in their own stores.
+        """
+        with cls._albums_lock:
+            cls._albums = {}
+            cls._albums_locks = {}
+        with cls._genre_lookups_lock:
+            cls._genre_lookups = {}
+        with cls._media_api_token_lock:
+            cls._media_api_token = None
+
+    @classmethod
+    def get_album(cls, album_id: str, url: str, language: str = None) -> AMAlbum or None:
+        """
+        Returns the AMAlbum of the given album id, fetching it from the given
+        url only if it wasn't fetched before during this run.
+        """
+        key = (album_id, language)
+        with cls._albums_lock:
+            album_lock = cls._albums_locks.setdefault(key, Lock())
+        with album_lock:
+            if key not in cls._albums:
+                album = cls.get_item_from_url(remove_url_param(url, AM_SONG_INDEX_PARAM), language)
+                if not album:
+                    return None
+                # Registered albums are used only for their own metadata:
+                album.discard_tracks()
+                cls._albums[key] = album
+            return cls._albums[key]
+
+    @classmethod
+    def _registered_album(cls, song: AMSong) -> AMAlbum or None:
+        return cls._albums.get((song.album_id_from_song_url(), song.language))
+
+    @classmethod
+    @timed('attach_album')
     def attach_album(cls, song: AMSong, album: AMAlbum = None):
         """
         Attaching AMAlbum object to a given AMSong's album attribute.
-        Returns 0 if succeed, and 1 otherwise.
+        Every album is fetched at most once, and shared between its songs.
         """
         if album:
             song.album = album
-        song.album = cls.get_item_from_url(song.url, song.language).album
+            return None
+        song.album = cls.get_album(song.album_id_from_song_url(), song.url, song.language)
 
     @classmethod
+    @timed('attach_albums')
+    def attach_albums(cls, songs: List[AMSong], workers: int = ALBUM_FETCH_WORKERS) -> List[AMSong]:
+        """
+        Attaching AMAlbum objects to the given AMSongs, using already fetched albums when
+        possible, and fetching the rest 'workers' albums at a time (every album once).
+        The albums are fetched from their pages rather than built from iTunes lookups,
+        which have neither the record label nor the album's artwork.
+        Returns the given songs, without (reported) songs whose album couldn't be fetched.
+        """
+        songs_by_album = {}
+        for song in songs:
+            songs_by_album.setdefault((song.album_id_from_song_url(), song.language), []).append(song)
+
+        def attach(album_songs: List[AMSong]):
+            try:
+                cls.attach_album(album_songs[0])
+            except Exception as e:
+                safe_print(f"--> WARNING: Couldn't fetch the album of '{album_songs[0].short_name}': {e}")
+            for song in album_songs[1:]:
+                song.album = album_songs[0].album
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(attach, songs_by_album.values()))
+        for song in songs:
+            if not song.album:
+                safe_print(f"--> ERROR: The album of '{song.short_name}' was not found, skipping it.")
+        return [song for song in songs if song.album]
+
+    @classmethod
+    def _attach_itunes_albums(cls, songs: List[AMSong], results: dict):
+        itunes_albums = {}
+        for song in songs:
+            registered_album = cls._registered_album(song)
+            if registered_album:
+                song.album = registered_album
+                continue
+            album_id = song.album_id_from_song_url()
+            if album_id not in results['collections']:
+                try:
+                    cls.attach_album(song)
+                except Exception as e:
+                    safe_print(f"--> WARNING: Couldn't fetch the album of '{song.short_name}': {e}")
+                continue
+            if album_id not in itunes_albums:
+                itunes_albums[album_id] = cls._album_from_itunes(album_id, results['collections'][album_id],
+                                                                 song.genres)
+            song.album = itunes_albums[album_id]
+
+    @staticmethod
+    def _album_from_itunes(album_id: str, itunes_album: dict, genres: List[str]) -> AMAlbum:
+        album_json = {
+            'id': album_id,
+            'attributes': {
+                'artistName': itunes_album['artistName'],
+                'genreNames': genres,
+                'recordLabel': None,
+                'trackCount': itunes_album.get('trackCount')
+            }
+        }
+        if 'copyright' in itunes_album:
+            album_json['attributes']['copyright'] = itunes_album['copyright']
+        return AMAlbum(album_json)
+
+    @classmethod
+    @timed('translate_item')
     def translate_item(cls, item: AMSong or AMAlbum):
         """
         Translates first genre to English.
         """
-        i = 0
-        genre = item.genres[i]
+        cls.finish_translating(item, cls.start_translating(item))
+
+    @classmethod
+    def start_translating(cls, item: AMSong or AMAlbum) -> Future or None:
+        """
+        Translates the first genre of a given item to English if its translation is known.
+        Otherwise, starts looking it up in the background (once per genre, even for concurrent
+        items) and returns the lookup's future, to be passed to 'finish_translating'.
+        """
+        genre = item.genres[0]
         if not has_hebrew(genre):
-            pass
-        elif genre in GENRES_TRANSLATION:
-            item.genres[i] = GENRES_TRANSLATION[genre]
+            return None
+        translated_genre = GENRES_STORE.get(genre)
+        if translated_genre:
+            item.genres[0] = translated_genre
+            return None
+        with cls._genre_lookups_lock:
+            if not cls._genre_lookups_executor:
+                cls._genre_lookups_executor = ThreadPoolExecutor(max_workers=GENRE_LOOKUP_WORKERS)
+            if genre not in cls._genre_lookups:
+                cls._genre_lookups[genre] = cls._genre_lookups_executor.submit(cls._lookup_genre, genre, item)
+            return cls._genre_lookups[genre]
+
+    @classmethod
+    @timed('genre_wait')
+    def finish_translating(cls, item: AMSong or AMAlbum, lookup: Future or None):
+        """
+        Waits for a genre lookup started by 'start_translating', and translates the item's
+        first genre with its result. The item keeps its genre if the lookup failed.
+        """
+        if not lookup:
+            return None
+        genre = item.genres[0]
+        try:
+            item.genres[0] = lookup.result()
+        except Exception as e:
+            safe_print(f"--> WARNING: Couldn't translate the genre '{genre}': {e}")
+            with cls._genre_lookups_lock:
+                if cls._genre_lookups.get(genre) is lookup:
+                    del cls._genre_lookups[genre]
+
+    @classmethod
+    @timed('genre_lookup')
+    def _lookup_genre(cls, genre: str, item: AMSong or AMAlbum) -> str:
+        """
+        Returns the English name of a given item's genre, using the item's English iTunes lookup
+        (and its English page only if the lookup has no results), and saves it to the genres store.
+        """
+        results = get_json(ITUNES_GENRE_QUERY.format(id=item.id))['results']
+        if results:
+            translated_genre = results[0]['primaryGenreName']
         else:
-            translated_genre = cls.get_item_from_url(update_url_param(item.url, 'l', 'en')).genres[i]
-            item.genres[i] = translated_genre
-            GENRES_TRANSLATION[genre] = translated_genre
+            translated_genre = cls.get_item_from_url(update_url_param(item.url, AM_LANGUAGE_PARAM, 'en')).genres[0]
+        GENRES_STORE.set(genre, translated_genre)
+        return translated_genre
 
     @classmethod
-    def _search_item(cls, name: str, item_type: AMSong or AMAlbum, limit: int) -> AMSong or AMAlbum:
+    def _query_items(cls, name: str, item_type: AMSong or AMAlbum, limit: int, **kwargs) -> List[AMObject]:
         query_results = cls.query(name, limit)
-        items = cls.json_to_items(query_results, item_type)
+        return cls.json_to_items(query_results, item_type, **kwargs)
+
+    @classmethod
+    def _choose_item(cls, items: List[AMObject], name: str) -> AMSong or AMAlbum:
         item = cls.get_item(items, name)
         item.language = get_language(name)
         return item
 
     @classmethod
-    def search_song(cls, name: str, limit: int = None) -> AMSong:
+    def _search_item(cls, name: str, item_type: AMSong or AMAlbum, limit: int) -> AMSong or AMAlbum:
+        items = cls._query_items(name, item_type, limit)
+        return cls._choose_item(items, name)
+
+    @classmethod
+    def query_songs(cls, name: str, limit: int = None, add_album=True) -> List[AMSong]:
         """
-        Querying Apple Music with given limit for a given name, determines
-        the song's language, prompts user for choosing the correct song,
-        attaches the song the album's object and returns the AMSong object.
+        Querying Apple Music with given limit for a given name and returns the
+        found AMSong objects, without prompting the user.
+        Without 'add_album', the songs' albums are left to be attached later (see 'attach_albums').
+        Safe to call from worker threads.
         """
         if not limit:
             limit = SONG_SEARCH_LIMIT
-        song = cls._search_item(name, AMSong, limit)
+        return cls._query_items(name, AMSong, limit, add_album=add_album)
+
+    @classmethod
+    def choose_song(cls, songs: List[AMSong], name: str) -> AMSong:
+        """
+        Prompts user for choosing the correct song out of the given query results
+        of the given name, determines the song's language and returns the AMSong object.
+        """
+        song = cls._choose_item(songs, name)
         if not song:
             return AMSong()
         return song
 
+    @classmethod
+    def search_song(cls, name: str, limit: int = None) -> AMSong:
+        """
+        Querying Apple Music with given limit for a given name, determines
+        the song's language, prompts user for choosing the correct song,
+        attaches the song the album's object and returns the AMSong object.
+        """
+        return cls.choose_song(cls.query_songs(name, limit), name)
+
     @classmethod
     def search_album(cls, name: str, limit: int = ALBUM_SEARCH_LIMIT):
         album = cls._search_item(name, AMAlbum, limit)
@@ -354,23 +788,79 @@ class AMFunctions:
     def get_item_from_url(cls, url: str, force_language: str = None):
         if force_language:
             url = update_url_param(url, AM_LANGUAGE_PARAM, force_language)
-        response = get(url).content
-        item = cls._get_item_from_html(response)
+        shoebox = get_content_between(url, AM_SHOEBOX_START, AM_SHOEBOX_END)
+        item = cls._get_item_from_shoebox(shoebox)
         index = get_url_param_value(url, 'i')
         return item if not index else item[index]
 
+    @staticmethod
+    def _shoebox_entry(shoebox: str, index: int) -> str:
+        """
+        Returns the (still json encoded) value of the shoebox entry at the given index,
+        skipping the entries before it without parsing their json.
+        Strings are skipped by the json scanner rather than a regex, whose backtracking
+        state grows with the string's length (hundreds of MBs for large entries).
+        """
+
+        def skip(pattern, position):
+            return pattern.match(shoebox, JSON_WHITESPACE_REGEX.match(shoebox, position).end()).end()
+
+        def skip_string(position):
+            position = JSON_WHITESPACE_REGEX.match(shoebox, position).end()
+            if shoebox[position] != '"':
+                raise ValueError(f"Expected a json string at {position}")
+            return scanstring(shoebox, position + 1)[1]
+
+        position = JSON_WHITESPACE_REGEX.match(shoebox).end() + 1
+        for _ in range(index):
+            position = skip_string(position)
+            position = skip_string(skip(JSON_SEPARATOR_REGEX, position))
+            position = skip(JSON_SEPARATOR_REGEX, position)
+        position = skip(JSON_SEPARATOR_REGEX, skip_string(position))
+        position = JSON_WHITESPACE_REGEX.match(shoebox, position).end()
+        return JSONDecoder().raw_decode(shoebox, position)[0]
+
     @classmethod
-    def _get_item_from_html(cls, html):
-        m = search(AM_REGEX, html)
+    def _get_item_from_shoebox(cls, shoebox: bytes):
         try:
-            json = loads(m.group(1))
-            json_data = loads(json[list(json.keys())[1]])['d'][0]
-        except (KeyError, AttributeError):
+            json_data = loads(cls._shoebox_entry(shoebox.decode(), AM_SHOEBOX_ENTRY))['d'][0]
+        except (KeyError, IndexError, AttributeError, ValueError):
             print("--> ERROR: The given URL is not supported!")
             return None
         item_type = json_data['type']
         return cls.AM_TYPES[item_type](json_data) if item_type in cls.AM_TYPES else json_data
 
+    @classmethod
+    def media_api_token(cls, page_url: str, expired_token: str = None) -> str:
+        """
+        Returns the Apple Music web player's API token, read from the environment
+        configuration of a given Apple Music page (once, or again if the kept token is the given expired one).
+        """
+        with cls._media_api_token_lock:
+            if not cls._media_api_token or cls._media_api_token == expired_token:
+                environment = get_content_between(page_url, AM_ENVIRONMENT_START, AM_ENVIRONMENT_END)
+                if not environment:
+                    raise ValueError("Apple Music's API token was not found.")
+                cls._media_api_token = loads(unquote(environment.decode()))['MEDIA_API']['token']
+            return cls._media_api_token
+
+    @classmethod
+    def get_tracks_page(cls, next_page: str, page_url: str, language: str = AM_DEFAULT_LANGUAGE) -> Tuple[list, str]:
+        """
+        Returns the tracks of a given tracks page (the 'next' path of a playlist's tracks)
+        and the path of the page that follows it (or MISSING for the last page).
+        """
+        url = update_url_param(AM_API_URL + next_page, AM_LANGUAGE_PARAM, language)
+        token = cls.media_api_token(page_url)
+        response = get(url, headers={'Authorization': f"Bearer {token}", 'Origin': AM_ORIGIN})
+        if response.status_code == 401:
+            # The token has expired - it's read again from the (uncached) playlist page:
+            token = cls.media_api_token(page_url, expired_token=token)
+            response = get(url, headers={'Authorization': f"Bearer {token}", 'Origin': AM_ORIGIN})
+        response.raise_for_status()
+        json = response.json()
+        return json['data'], json.get('next', MISSING)
+
     @staticmethod
     def _artwork_url_customize(url):
         custom_url = url.split('/')
@@ -379,7 +869,7 @@ class AMFunctions:
     @staticmethod
     def query_itunes(item_id: str, language: str = 'he', query_album=False):
         query_url = ITUNES_SONG_QUERY if not query_album else ITUNES_ALBUM_QUERY
-        return get(query_url.format(id=item_id, language=language)).json()['results']
+        return get_json(query_url.format(id=item_id, language=language))['results']
 
     @staticmethod
     def itunes_results_to_dict(query_results):
@@ -394,26 +884,61 @@ class AMFunctions:
         return results
 
     @classmethod
-    def update_metadata(cls, collection: AMAlbum or AMPlaylist, add_album=False):
-        song_ids = [song.id for song in collection.songs]
-        results = cls.query_itunes(','.join(song_ids), query_album=True)
-        results = cls.itunes_results_to_dict(results)
-        for song in collection.found_songs:
-            album_id = song.album_id_from_song_url()
-            itunes_song = results['tracks'][song.id]
-            if add_album:
-                itunes_album = results['collections'][album_id]
-                album_json = {
-                    'id': album_id,
-                    'attributes': {
-                        'artistName': itunes_album['artistName'],
-                        'genreNames': song.genres,
-                        'recordLabel': None
-                    }
-                }
-                if 'copyright' in itunes_album:
-                    album_json['attributes']['copyright'] = itunes_album['copyright']
-                song.album = AMAlbum(album_json)
+    def query_itunes_batched(cls, item_ids: Iterable[str], language: str = 'he', query_album=False,
+                             batch_size: int = ITUNES_BATCH_SIZE, workers: int = ITUNES_BATCH_WORKERS) -> dict:
+        """
+        Looks up the given ids on iTunes in groups of up to 'batch_size' ids, 'workers' groups at a time.
+        Groups that failed are retried (only them), up to ITUNES_BATCH_RETRIES times.
+        Returns the merged results, in the format of 'itunes_results_to_dict'.
+        """
+        item_ids = list(dict.fromkeys(item_ids))
+        groups = [item_ids[i:i + batch_size] for i in range(0, len(item_ids), batch_size)]
+        results = {'tracks': {}, 'collections': {}}
+        error = None
+        for _ in range(ITUNES_BATCH_RETRIES + 1):
+            if not groups:
+                break
+            failed_groups = []
+            with ThreadPoolExecutor(max_workers=min(workers, len(groups))) as executor:
+                futures = {executor.submit(cls.query_itunes, ','.join(group), language, query_album): group
+                           for group in groups}
+                for future in as_completed(futures):
+                    try:
+                        group_results = cls.itunes_results_to_dict(future.result())
+                    except Exception as e:
+                        error = e
+                        failed_groups.append(futures[future])
+                        continue
+                    for results_type, type_results in group_results.items():
+                        results[results_type].update(type_results)
+            groups = failed_groups
+        if groups:
+            safe_print(f"--> WARNING: iTunes lookup of {sum(map(len, groups))} ids failed: {error}")
+        return results
+
+    @classmethod
+    def update_metadata(cls, songs: List[AMSong], add_album=False) -> List[AMSong]:
+        """
+        Updates the track and disc numbers of the given songs (and their albums,
+        if 'add_album' is set) from batched iTunes lookups.
+        Songs that were not found on iTunes are reported and keep their metadata.
+        Returns the given songs, without (reported) songs whose album couldn't be found if 'add_album' is set.
+        """
+        results = cls.query_itunes_batched([song.id for song in songs], query_album=True)
+        if add_album:
+            cls._attach_itunes_albums(songs, results)
+            for song in songs:
+                if not song.album:
+                    safe_print(f"--> ERROR: The album of '{song.short_name}' was not found, skipping it.")
+            songs = [song for song in songs if song.album]
+        for song in songs:
+            itunes_song = results['tracks'].get(song.id)
+            if not itunes_song:
+                safe_print(f"--> WARNING: Song '{song.short_name}' was not found on iTunes, "
+                           f"its track and disc numbers are missing.")
+                continue
             song.track_number = str(itunes_song['trackNumber'])
-            song.album.track_count = str(itunes_song['trackCount'])
+            if song.album:
+                song.album.track_count = str(itunes_song['trackCount'])
             song.disc_number = f"{itunes_song['discNumber']}/{itunes_song['discCount']}"
+        return songs
@@ -0,0 +1,124 @@
+from os import makedirs, environ
+from os.path import join, expanduser, dirname
+from threading import Lock
+from time import time
+import sqlite3
+
+CACHE_DIR = join(environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'), 'segevmusic')
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# Expired entries are purged (and the total size recounted) every PURGE_EVERY writes, and once the cache
+# is over its max size, least recently used entries are evicted until it's back under EVICT_TO of it.
+PURGE_EVERY = 256
+EVICT_TO = 0.9
+EVICT_BATCH = 64
+
+CREATE_TABLE = "CREATE TABLE IF NOT EXISTS responses (" \
+               "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, " \
+               "expires REAL NOT NULL, accessed REAL NOT NULL)"
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+CREATE_EXPIRES_INDEX = "CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires)"
+
+
+class ResponseCache:
+    """
+    A size bounded, on-disk (SQLite) key-value cache with per-entry expiry.
+    Least recently used entries are evicted once the cache grows past its max size.
+    The total size is kept as a running count, so writes don't scan the whole cache.
+    """
+
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._lock = Lock()
+        self._db = None
+        self._size = None
+        self._writes = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            makedirs(dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(CREATE_TABLE)
+            self._db.execute(CREATE_INDEX)
+            self._db.execute(CREATE_EXPIRES_INDEX)
+        return self._db
+
+    def _count_size(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        """
+        The (running) total size of the cached values. Must be used while holding the lock.
+        """
+        if self._size is None:
+            self._size = self._count_size()
+        return self._size
+
+    def get(self, key: str) -> bytes or None:
+        """
+        Returns the cached value of the given key, or None if missing or expired.
+        """
+        now = time()
+        with self._lock:
+            row = self.db.execute("SELECT value, size, expires FROM responses WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            value, size, expires = row
+            if expires < now:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size = self.size - size
+                return None
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return bytes(value)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        """
+        Caches the given value for 'ttl' seconds, evicting old entries if needed.
+        """
+        now = time()
+        with self._lock:
+            size = self.size
+            replaced = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                            (key, value, len(value), now + ttl, now))
+            self._size = size + len(value) - (replaced[0] if replaced else 0)
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0 or self._size > self.max_size:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        """
+        Purges the expired entries, and if the cache is still over its max size, evicts the least
+        recently used entries until it's under EVICT_TO of it.
+        The total size is recounted first, as other processes may share the cache.
+        """
+        self.db.execute("DELETE FROM responses WHERE expires < ?", (now,))
+        self._size = self._count_size()
+        if self._size <= self.max_size:
+            return None
+        target_size = self.max_size * EVICT_TO
+        while self._size > target_size:
+            rows = self.db.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT ?",
+                                   (EVICT_BATCH,)).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                if self._size <= target_size:
+                    break
+
+    def clear(self):
+        with self._lock:
+            self.db.execute("DELETE FROM responses")
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                self._size = None
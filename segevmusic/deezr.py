@@ -1,76 +1,356 @@
 from segevmusic.overriders import LogListener, DEFAULT_DEEMIX_SETTINGS
-from os.path import realpath, join, exists
-from typing import Iterable
-from sys import stdout
+from segevmusic.utils import safe_print
+from segevmusic.fetcher import get_json
+from segevmusic.limiter import LIMITER_STATS, MAX_RETRIES, host_bucket, backoff
+from segevmusic.cache import ResponseCache, CACHE_DIR
+from segevmusic.profiler import PROFILER, timed
+from os import makedirs, replace, remove, chmod
+from os.path import realpath, join, exists, dirname
+from json import load, dump, loads, dumps
+from hashlib import sha256
+from threading import Thread
+from queue import Queue
+from time import time
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterable, Iterator, Tuple, Dict, List
 
 from deezer import Deezer
 from deezer import TrackFormats
 from deemix.downloader import Downloader
 from deemix import generateDownloadObject
-from deemix.itemgen import GenerationError
+from deemix.itemgen import GenerationError, generateTrackItem
 
 DEEZER_ISRC_QUERY = r"https://api.deezer.com/2.0/track/isrc:{isrc}"
+DEEZER_NO_DATA_ERROR = 800
+DEEZER_QUOTA_ERROR = 4
+DEEZER_API_HOST = 'api.deezer.com'
+DEEZER_TRACKS_CACHE_PATH = join(CACHE_DIR, 'deezer-tracks.sqlite')
+DEEZER_TRACKS_CACHE_TTL = 30 * 24 * 60 * 60
+RESOLVE_WORKERS = 8
+DEEZER_SESSION_PATH = join(CACHE_DIR, 'deezer-session.json')
+DEEZER_SESSION_TTL = 7 * 24 * 60 * 60
+DEEZER_SESSION_REFRESH_AFTER = 24 * 60 * 60
+
+
+class DeezerLoginError(Exception):
+    """
+    Logging in to Deezer failed, and the arl can't be asked for.
+    """
+
+
+class DeezerSessionStore:
+    """
+    Keeps a logged in Deezer session (its user data and cookies) on disk, so later runs
+    can reuse it without logging in again until it expires.
+    """
+
+    def __init__(self, path: str = DEEZER_SESSION_PATH, ttl: int = DEEZER_SESSION_TTL,
+                 refresh_after: int = DEEZER_SESSION_REFRESH_AFTER):
+        self.path = path
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+
+    @staticmethod
+    def _arl_hash(arl: str) -> str:
+        return sha256(arl.strip().encode()).hexdigest()
+
+    def load(self, arl: str) -> dict or None:
+        """
+        Returns the saved session of the given arl, or None if there is no such valid session.
+        """
+        try:
+            with open(self.path) as f:
+                saved = load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get('arl_hash') != self._arl_hash(arl) or time() - saved.get('saved_at', 0) > self.ttl:
+            return None
+        return saved
+
+    def save(self, arl: str, app: Deezer):
+        """
+        Saves the session of a given logged in Deezer object.
+        """
+        makedirs(dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            dump({'arl_hash': self._arl_hash(arl), 'saved_at': time(), 'session': app.get_session()}, f)
+        # The session's cookies are credentials:
+        chmod(temp_path, 0o600)
+        replace(temp_path, self.path)
+
+    def needs_refresh(self, saved: dict) -> bool:
+        return time() - saved['saved_at'] > self.refresh_after
+
+    def clear(self):
+        try:
+            remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def restore(app: Deezer, session: dict):
+        """
+        Restores a saved session into a given Deezer object.
+        Unlike 'Deezer.set_session', keeps the object's requests session (which is shared with
+        its API objects) and only updates its cookies.
+        """
+        app.session.cookies.update(session['cookies'])
+        app.childs = session['childs']
+        app.logged_in = session['logged_in']
+        app.change_account(session['selected_account'])
+
+    def refresh(self, arl: str):
+        """
+        Logs in again with the given arl in the background, and saves the new session.
+        """
+        Thread(target=self._refresh, args=(arl,), daemon=True).start()
+
+    def _refresh(self, arl: str):
+        app = Deezer()
+        try:
+            logged_in = app.login_via_arl(arl)
+        except Exception:
+            return None
+        if logged_in:
+            self.save(arl, app)
+        else:
+            self.clear()
+            safe_print("--> WARNING: The saved Deezer session has expired; Run again to log in.")
 
 
 class DeezerFunctions:
     """
     A functions toolbox for using Deezer and deemix.
     """
+    use_tracks_cache = True
+    session_store = DeezerSessionStore()
+    _tracks = {}
+    _tracks_cache = ResponseCache(DEEZER_TRACKS_CACHE_PATH)
 
-    @staticmethod
-    def login(arl: str, songs_path=''):
+    @classmethod
+    def login(cls, arl: str, songs_path='', interactive: bool = True):
         """
         Initializing Deezer session.
+        A saved session of the given arl is reused (and refreshed in the background if it's old),
+        otherwise logs in and saves the new session.
+        If logging in fails, another arl is asked for - or a DeezerLoginError is raised if not 'interactive'.
+        Every session gets its own copy of the settings.
         """
         localpath = realpath('.')
-        config_folder = join(localpath, 'config')
         songs_folder = realpath(songs_path) if songs_path else join(localpath, 'Songs')
         app = Deezer()
 
-        app.login_via_arl(arl)
-        while not app.logged_in:
-            arl = input("Enter your arl here: ")
+        saved = cls.session_store.load(arl)
+        if saved:
+            cls.session_store.restore(app, saved['session'])
+            if cls.session_store.needs_refresh(saved):
+                cls.session_store.refresh(arl)
+        else:
             app.login_via_arl(arl)
-        app.settings = DEFAULT_DEEMIX_SETTINGS
+            if not app.logged_in and not interactive:
+                raise DeezerLoginError("Logging in to Deezer failed - the arl is invalid or has expired.")
+            while not app.logged_in:
+                arl = input("Enter your arl here: ")
+                app.login_via_arl(arl)
+            cls.session_store.save(arl, app)
+        app.settings = deepcopy(DEFAULT_DEEMIX_SETTINGS)
         app.settings['downloadLocation'] = songs_folder
         return app
 
     @staticmethod
     def _amsong_to_url(amsong) -> str:
         """
-        Generates and returns deezer link for a given AMSong object (using ISRC).
+        Generates and returns deezer link for a given AMSong object.
         """
         return DEEZER_ISRC_QUERY.format(isrc=amsong.isrc)
 
+    @classmethod
+    def forget_tracks(cls):
+        """
+        Forgets the tracks resolved so far (they're still kept in the persistent cache).
+        """
+        cls._tracks = {}
+
+    @classmethod
+    def resolve_isrc(cls, isrc: str) -> dict or None:
+        """
+        Returns the deezer track (API json) of a given ISRC, or None if there is no such track on deezer.
+        Results are kept in a persistent cache.
+        """
+        if cls.use_tracks_cache:
+            cached = cls._tracks_cache.get(isrc)
+            if cached == b'':
+                return None
+            # Entries of older versions hold only the track id, and are resolved again:
+            track = loads(cached) if cached is not None else None
+            if isinstance(track, dict):
+                return track
+        json = cls._get_track(isrc)
+        if 'error' in json and json['error'].get('code') != DEEZER_NO_DATA_ERROR:
+            raise ValueError(f"Deezer lookup of {isrc} failed: {json['error'].get('message')}")
+        # The track token expires, and deemix doesn't need it:
+        track = {key: value for key, value in json.items() if key != 'track_token'} if 'id' in json else None
+        if cls.use_tracks_cache:
+            cls._tracks_cache.set(isrc, dumps(track).encode() if track else b'', DEEZER_TRACKS_CACHE_TTL)
+        return track
+
+    @staticmethod
+    @timed('deezer_lookup')
+    def _get_track(isrc: str) -> dict:
+        """
+        Returns the deezer API response of a given ISRC.
+        The API reports exceeded quotas in the json body rather than with a 429 status,
+        so those are backed off and retried here.
+        """
+        bucket = host_bucket(DEEZER_API_HOST)
+        for attempt in range(MAX_RETRIES + 1):
+            json = get_json(DEEZER_ISRC_QUERY.format(isrc=isrc))
+            if json.get('error', {}).get('code') != DEEZER_QUOTA_ERROR or attempt == MAX_RETRIES:
+                return json
+            LIMITER_STATS.add(DEEZER_API_HOST, 'throttled')
+            LIMITER_STATS.add(DEEZER_API_HOST, 'retries')
+            bucket.pause(backoff(attempt + 1))
+
+    @classmethod
+    def _resolve_song(cls, song):
+        try:
+            cls._tracks[song.isrc] = cls.resolve_isrc(song.isrc)
+        except Exception as e:
+            safe_print(f"--> WARNING: {e}")
+
+    @classmethod
+    def resolve_songs(cls, songs: Iterable, workers: int = RESOLVE_WORKERS) -> List:
+        """
+        Resolves the deezer tracks of the given songs concurrently (skipping already resolved songs),
+        so their downloads can start right away, without looking them up again.
+        Returns the songs that have no matching track on deezer.
+        """
+        songs = list(songs)
+        unresolved_songs = list({song.isrc: song for song in songs if song.isrc not in cls._tracks}.values())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(cls._resolve_song, unresolved_songs))
+        return [song for song in songs if song.isrc in cls._tracks and not cls._tracks[song.isrc]]
+
+    @classmethod
+    def start_resolving(cls, songs: Iterable) -> Future:
+        """
+        Starts resolving the deezer tracks of the given songs in the background.
+        Returns a future of the songs that have no matching track on deezer.
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(cls.resolve_songs, list(songs))
+        executor.shutdown(wait=False)
+        return future
+
     @staticmethod
     def song_exists(song, download_path):
         return exists(join(download_path, f"{song.isrc}.mp3"))
 
     @classmethod
-    def download(cls, songs: Iterable, app):
+    def download(cls, songs: Iterable, app, workers: int = None) -> Dict:
+        """
+        Downloads given songs, 'workers' songs at a time (defaults to the
+        'queueConcurrency' setting).
+        Returns a dict of every song and whether it was downloaded.
+        """
+        return dict(cls.iter_download(songs, app, workers))
+
+    @classmethod
+    def iter_download(cls, songs: Iterable, app, workers: int = None) -> Iterator[Tuple]:
         """
-        Downloads given deezer links.
+        Downloads given songs, 'workers' songs at a time (defaults to the
+        'queueConcurrency' setting).
+        The songs may arrive lazily - each song starts downloading as soon as it's
+        given, while the rest are still being generated.
+        Songs of an ISRC that was already given are skipped, as they would be downloaded to the same file.
+        Yields every song and whether it was downloaded, as soon as its download ends.
         """
-        download_path = app.settings['downloadLocation']
-        for song in songs:
-            print(f"--> Downloading '{song.short_name}'...", end='')
+        workers = workers or app.settings['queueConcurrency']
+        finished = Queue()
+
+        def submit_songs():
+            submitted = 0
+            submitted_isrcs = set()
             try:
-                cls.download_link(app, cls._amsong_to_url(song))
+                for song in songs:
+                    if song.isrc in submitted_isrcs:
+                        continue
+                    submitted_isrcs.add(song.isrc)
+                    future = executor.submit(cls.download_song, song, app)
+                    future.add_done_callback(lambda done, song=song: finished.put((song, done.result())))
+                    submitted += 1
             except Exception as e:
-                print(e)
-            stdout.flush()
-            if cls.song_exists(song, download_path):
-                print(f"\r--> Downloaded '{song.short_name}'!")
+                safe_print(f"--> ERROR: {e}")
+            finally:
+                finished.put(submitted)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            Thread(target=submit_songs, daemon=True).start()
+            total, done = None, 0
+            while total is None or done < total:
+                result = finished.get()
+                if isinstance(result, int):
+                    total = result
+                    continue
+                done += 1
+                yield result
+
+    @classmethod
+    @timed('deezer_download')
+    def download_song(cls, song, app) -> bool:
+        """
+        Downloads a given song and returns whether it was downloaded.
+        """
+        safe_print(f"--> Downloading '{song.short_name}'...")
+        try:
+            track = cls._tracks.get(song.isrc)
+            if track:
+                downloaded = cls.download_track(app, track)
             else:
-                print(f"\r--> ERROR: Song '{song.short_name}' was not downloaded!")
+                downloaded = cls.download_link(app, cls._amsong_to_url(song))
+        except Exception as e:
+            safe_print(f"--> ERROR: {e}")
+            downloaded = False
+        PROFILER.count('songs_downloaded' if downloaded else 'songs_not_downloaded')
+        if downloaded:
+            safe_print(f"--> Downloaded '{song.short_name}'!")
+        else:
+            safe_print(f"--> ERROR: Song '{song.short_name}' was not downloaded!")
+        return downloaded
 
-    @staticmethod
-    def download_link(app, link):
+    @classmethod
+    def download_link(cls, app, link) -> bool:
+        """
+        Downloads a given deezer link and returns whether it succeeded.
+        """
         listener = LogListener()
         bitrate = app.settings.get("maxBitrate", TrackFormats.MP3_320)
         try:
             obj = generateDownloadObject(app, link, bitrate, {}, listener)
         except GenerationError as e:
-            print(f"{e.link}: {e.message}")
+            safe_print(f"{e.link}: {e.message}")
+            return False
+        return cls._start_download(app, obj, listener)
+
+    @classmethod
+    def download_track(cls, app, track: dict) -> bool:
+        """
+        Downloads a given (already resolved) deezer track and returns whether it succeeded.
+        Unlike downloading its link, the track isn't looked up on the deezer API again.
+        """
+        listener = LogListener()
+        bitrate = app.settings.get("maxBitrate", TrackFormats.MP3_320)
+        try:
+            # deemix modifies the track json it's given:
+            obj = generateTrackItem(app, track['id'], bitrate, trackAPI=deepcopy(track))
+        except GenerationError as e:
+            safe_print(f"{e.link}: {e.message}")
             return False
+        return cls._start_download(app, obj, listener)
+
+    @staticmethod
+    def _start_download(app, obj, listener) -> bool:
         Downloader(app, obj, app.settings, listener).start()
+        return obj.downloaded > 0 and not obj.failed
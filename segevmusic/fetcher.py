@@ -0,0 +1,199 @@
+from segevmusic.cache import ResponseCache, CACHE_DIR
+from segevmusic.limiter import LIMITER_STATS, RETRY_STATUSES, MAX_RETRIES, host_bucket, backoff, retry_after
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from os.path import join
+from json import loads
+from re import compile
+from time import sleep
+
+HOST_CONCURRENCY = 4
+STREAM_CHUNK_SIZE = 64 * 1024
+HOUR = 60 * 60
+DAY = 24 * HOUR
+# (host, path pattern or None for every path, ttl) - the first matching endpoint's ttl is used.
+# Playlist pages (which also hold the web player's API token) change, and their later pages are
+# always fetched live, so they are not cached.
+ENDPOINT_TTLS = [
+    ('tools.applemediaservices.com', None, DAY),
+    ('music.apple.com', compile(r'/playlist/'), 0),
+    ('music.apple.com', compile(r'/(album|song)/'), 7 * DAY),
+    ('itunes.apple.com', None, 7 * DAY),
+    ('api.song.link', None, 30 * DAY)
+]
+RESPONSES_CACHE_PATH = join(CACHE_DIR, 'responses.sqlite')
+
+_host_semaphores = {}
+_host_semaphores_lock = Lock()
+_cache_settings = {
+    'enabled': True,
+    'refresh': False
+}
+_response_cache = ResponseCache(RESPONSES_CACHE_PATH)
+
+
+def configure_cache(enabled: bool = True, refresh: bool = False, path: str = None):
+    """
+    Sets whether responses are cached, and whether cached responses are ignored
+    (while still updating the cache with fresh ones).
+    """
+    global _response_cache
+    _cache_settings['enabled'] = enabled
+    _cache_settings['refresh'] = refresh
+    if path and path != _response_cache.path:
+        _response_cache.close()
+        _response_cache = ResponseCache(path)
+
+
+def normalize_url(url: str) -> str:
+    """
+    Returns the given url with a lower-cased scheme and host, sorted query
+    parameters and without a fragment, to be used as a cache key.
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+
+def endpoint_ttl(url: str) -> int:
+    """
+    Returns for how long (in seconds) responses of the given url may be cached,
+    or 0 if they should not be cached.
+    """
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    for endpoint_host, path_pattern, ttl in ENDPOINT_TTLS:
+        if endpoint_host == host and (path_pattern is None or path_pattern.search(parts.path)):
+            return ttl
+    return 0
+
+
+def host_semaphore(url: str) -> BoundedSemaphore:
+    """
+    Returns the semaphore capping concurrent requests to the given url's host.
+    """
+    host = urlsplit(url).netloc.lower()
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = BoundedSemaphore(HOST_CONCURRENCY)
+        return _host_semaphores[host]
+
+
+def get(url: str, retries: int = MAX_RETRIES, **kwargs):
+    """
+    Sends a GET request to the given url through the shared keep-alive transport,
+    waiting for a free slot and for the rate limit of its host.
+    Throttled (429), failed (5xx) and dropped requests are retried with a jittered exponential
+    backoff, or after the delay asked by the host's Retry-After header.
+    Returns the response object (of the last attempt).
+    """
+    from segevmusic.transport import session
+    from requests import ConnectionError, Timeout
+    host = urlsplit(url).hostname or ''
+    bucket = host_bucket(host)
+    for attempt in range(retries + 1):
+        LIMITER_STATS.add(host, 'waited', bucket.acquire())
+        LIMITER_STATS.add(host, 'requests')
+        try:
+            with host_semaphore(url):
+                response = session().get(url, **kwargs)
+        except (ConnectionError, Timeout):
+            LIMITER_STATS.add(host, 'connection_errors')
+            if attempt == retries:
+                LIMITER_STATS.add(host, 'failures')
+                raise
+            delay = backoff(attempt)
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            LIMITER_STATS.add(host, 'throttled' if response.status_code == 429 else 'server_errors')
+            if attempt == retries:
+                LIMITER_STATS.add(host, 'failures')
+                return response
+            delay = retry_after(response.headers)
+            if delay is None:
+                delay = backoff(attempt)
+            if response.status_code == 429:
+                bucket.pause(delay)
+            response.close()
+        LIMITER_STATS.add(host, 'retries')
+        sleep(delay)
+
+
+def get_content(url: str) -> bytes:
+    """
+    Returns the body of the given url.
+    Raises an HTTPError if the host kept throttling or failing the request.
+    Successful responses of known endpoints are served from and saved to the responses cache.
+    """
+    ttl = endpoint_ttl(url) if _cache_settings['enabled'] else 0
+    key = normalize_url(url)
+    if ttl and not _cache_settings['refresh']:
+        content = _response_cache.get(key)
+        if content is not None:
+            return content
+    response = get(url)
+    if response.status_code in RETRY_STATUSES:
+        response.raise_for_status()
+    if ttl and response.ok:
+        _response_cache.set(key, response.content, ttl)
+    return response.content
+
+
+def _read_between(chunks, start: bytes, end: bytes) -> bytes or None:
+    """
+    Reads the given chunks only until the 'end' marker that follows the 'start' marker,
+    keeping in memory only what may still be part of the wanted section.
+    Returns the bytes between the markers, or None if they were not found.
+    """
+    buffer = bytearray()
+    found_start = False
+    for chunk in chunks:
+        buffer += chunk
+        if not found_start:
+            start_index = buffer.find(start)
+            if start_index == -1:
+                del buffer[:max(len(buffer) - len(start) + 1, 0)]
+                continue
+            del buffer[:start_index + len(start)]
+            found_start = True
+            search_from = 0
+        end_index = buffer.find(end, search_from)
+        if end_index != -1:
+            # Truncated in place, so the section is copied only once:
+            del buffer[end_index:]
+            return bytes(buffer)
+        search_from = max(len(buffer) - len(end) + 1, 0)
+    return None
+
+
+def get_content_between(url: str, start: bytes, end: bytes) -> bytes or None:
+    """
+    Streams the body of the given url and returns only the part between the 'start' marker
+    and the following 'end' marker, closing the connection as soon as it is read.
+    Returns None if the markers were not found, and raises an HTTPError if the host kept
+    throttling or failing the request.
+    The extracted part is served from and saved to the responses cache.
+    """
+    ttl = endpoint_ttl(url) if _cache_settings['enabled'] else 0
+    key = f"{normalize_url(url)} {start.hex()} {end.hex()}"
+    if ttl and not _cache_settings['refresh']:
+        content = _response_cache.get(key)
+        if content is not None:
+            return content
+    with get(url, stream=True) as response:
+        if response.status_code in RETRY_STATUSES:
+            response.raise_for_status()
+        if not response.ok:
+            return None
+        content = _read_between(response.iter_content(STREAM_CHUNK_SIZE), start, end)
+    if ttl and content is not None:
+        _response_cache.set(key, content, ttl)
+    return content
+
+
+def get_json(url: str):
+    """
+    Returns the parsed json body of the given url.
+    """
+    return loads(get_content(url))
@@ -0,0 +1,97 @@
+from os import scandir, makedirs
+from os.path import realpath, join, exists, splitext
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Iterator, Tuple
+import sqlite3
+
+LIBRARY_INDEX_NAME = '.segevmusic-library.sqlite'
+LIBRARY_EXTENSIONS = {'.mp3'}
+REBUILD_WORKERS = 16
+
+CREATE_TABLE = "CREATE TABLE IF NOT EXISTS songs (isrc TEXT PRIMARY KEY, am_id TEXT, path TEXT NOT NULL)"
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS songs_am_id ON songs (am_id)"
+
+
+class LibraryIndex:
+    """
+    A persistent (SQLite) index of a library folder, mapping songs' ISRCs and
+    Apple Music ids to their final path in the library.
+    """
+
+    def __init__(self, library_path: str):
+        self.library_path = realpath(library_path)
+        self.path = join(self.library_path, LIBRARY_INDEX_NAME)
+        self._lock = Lock()
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            makedirs(self.library_path, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(CREATE_TABLE)
+            self._db.execute(CREATE_INDEX)
+        return self._db
+
+    def find(self, song) -> str or None:
+        """
+        Returns the library path of a given AMSong (looked up by its Apple Music id,
+        and then by its ISRC), or None if it's not in the library.
+        Entries of files that no longer exist are forgotten.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT isrc, path FROM songs WHERE am_id = ? OR isrc = ? "
+                                  "ORDER BY am_id = ? DESC", (song.id, song.isrc, song.id)).fetchone()
+            if not row:
+                return None
+            isrc, path = row
+            if exists(path):
+                return path
+            with self.db:
+                self.db.execute("DELETE FROM songs WHERE isrc = ?", (isrc,))
+            return None
+
+    def add(self, song, path: str):
+        """
+        Records the library path of a given AMSong.
+        """
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO songs VALUES (?, ?, ?)", (song.isrc, song.id, realpath(path)))
+
+    def _scan(self, path: str) -> Iterator[str]:
+        """
+        Yields the paths of every song file under the given folder.
+        """
+        with scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._scan(entry.path)
+                elif splitext(entry.name)[1].lower() in LIBRARY_EXTENSIONS:
+                    yield entry.path
+
+    @staticmethod
+    def _read_isrc(path: str) -> Tuple[str, str or None]:
+        from mutagen.id3 import ID3
+        try:
+            frames = ID3(path).getall('TSRC')
+        except Exception:
+            return path, None
+        return path, str(frames[0].text[0]) if frames and frames[0].text else None
+
+    def rebuild(self, workers: int = REBUILD_WORKERS) -> int:
+        """
+        Rebuilds the index from the ISRC (TSRC) tags of the song files found in the library,
+        reading them in parallel.
+        Apple Music ids of songs that are still found in the same path are kept.
+        Returns the number of indexed songs.
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            found = [(isrc, path) for path, isrc in executor.map(self._read_isrc, self._scan(self.library_path))
+                     if isrc]
+        with self._lock, self.db:
+            am_ids = dict(self.db.execute("SELECT path, am_id FROM songs").fetchall())
+            self.db.execute("DELETE FROM songs")
+            self.db.executemany("INSERT OR REPLACE INTO songs VALUES (?, ?, ?)",
+                                [(isrc, am_ids.get(path), path) for isrc, path in found])
+        return len(found)
@@ -0,0 +1,117 @@
+from threading import Lock
+from time import monotonic, sleep, time
+from random import uniform
+from email.utils import parsedate_to_datetime
+
+DEFAULT_HOST_RATE = (10.0, 10)
+HOST_RATES = {
+    'api.song.link': (10 / 60, 5),
+    'api.deezer.com': (10.0, 50),
+    'itunes.apple.com': (5.0, 10)
+}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+class TokenBucket:
+    """
+    A token bucket allowing 'rate' requests per second on average, and bursts of up to
+    'capacity' requests. Can be paused (e.g. when the host asks to slow down).
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+        self.paused_until = 0.0
+        self._lock = Lock()
+
+    def _reserve(self) -> float:
+        """
+        Takes a token, and returns for how long to wait before using it.
+        """
+        with self._lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def acquire(self) -> float:
+        """
+        Waits until a request may be sent.
+        Returns how long it waited.
+        """
+        wait = self._reserve()
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+
+class HostStats:
+    """
+    Per host counters of sent requests, retries, throttling (429), server errors,
+    failures and time spent waiting for the rate limiter.
+    """
+    COUNTERS = ('requests', 'retries', 'throttled', 'server_errors', 'connection_errors', 'failures')
+
+    def __init__(self):
+        self.hosts = {}
+        self._lock = Lock()
+
+    def add(self, host: str, counter: str, value: float = 1):
+        with self._lock:
+            host_stats = self.hosts.setdefault(host, dict.fromkeys(self.COUNTERS + ('waited',), 0))
+            host_stats[counter] += value
+
+    def report(self) -> dict:
+        with self._lock:
+            return {host: dict(stats) for host, stats in self.hosts.items()}
+
+
+LIMITER_STATS = HostStats()
+
+_buckets = {}
+_buckets_lock = Lock()
+
+
+def host_bucket(host: str) -> TokenBucket:
+    """
+    Returns the token bucket shared by every request to the given host.
+    """
+    with _buckets_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(*HOST_RATES.get(host, DEFAULT_HOST_RATE))
+        return _buckets[host]
+
+
+def backoff(attempt: int) -> float:
+    """
+    Returns a jittered, exponentially growing delay for the given retry attempt.
+    """
+    return uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after(headers) -> float or None:
+    """
+    Returns the delay (in seconds) asked by a response's Retry-After header, if any.
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return min(max(float(value), 0.0), BACKOFF_MAX)
+    except ValueError:
+        pass
+    try:
+        return min(max(parsedate_to_datetime(value).timestamp() - time(), 0.0), BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return None
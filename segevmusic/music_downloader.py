@@ -1,40 +1,90 @@
-from segevmusic.tagger import Tagger
-from segevmusic.applemusic import AMFunctions, AMSong, AM_DOMAIN
-from segevmusic.deezr import DeezerFunctions
-from segevmusic.wetransfer import WTSession
-from segevmusic.utils import get_lines, get_indexes, newline, convert_platform_link
-from os.path import realpath
+from segevmusic.applemusic import AMFunctions, AMSong, AMPlaylist, AM_DOMAIN, ARTWORK_CACHE
+from segevmusic.library import LibraryIndex
+from segevmusic.utils import get_lines, get_indexes, newline, convert_platform_link, convert_platform_links, \
+    safe_print
+from segevmusic.fetcher import configure_cache
+from segevmusic.profiler import PROFILER, PROFILE_PATH, timed
+from os.path import realpath, exists
 from argparse import ArgumentParser, Namespace
-from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Thread
+from queue import Queue
+from time import perf_counter
+from typing import Iterable, Iterator, List
 
 REQUERY_LIMIT = 5
+RESOLVE_WORKERS = 8
+PIPELINE_QUEUE_SIZE = 8
 ARL = "3cccd48d1ba2db1fe9067baf059eaa053cba6e5c3f815a54b1fc4e4f5da72f72fbd8c3f30bd704360a88066bc1b1280b44d7e7d8f2a5bf" \
       "33dfcbbf2863de56b123fd0334066f5d2c9da4a279fd29c48c875f497502687107598334b67eb5a37a"
 
 
 class MusicDownloader:
-    def __init__(self):
-        args = self.get_args()
+    def __init__(self, args: Namespace = None):
+        args = args or self.get_args()
         self.download_path = args.path
         self.to_upload = args.upload
         self.file_path = args.file
         self.all_album = args.album
         self.link = args.link
         self.links = args.links
+        self.jobs = args.jobs
+        self.reindex = args.reindex
         self.to_check = args.check if not any((args.album, args.link, args.links)) else False
+        configure_cache(enabled=args.cache, refresh=args.refresh)
+        ARTWORK_CACHE.use_disk = args.cache
+        self.use_cache = args.cache
+        self.profile_path = args.profile or (PROFILE_PATH if args.prometheus else None)
+        self.prometheus_path = args.prometheus
+        if self.profile_path:
+            PROFILER.reset()
+            PROFILER.enabled = True
 
-        self.app = DeezerFunctions.login(ARL, self.download_path)
-        self.tagger = Tagger(self.download_path)
+        self.app = None
+        self.interactive = True
+        self.wt_session = None
+        self._tagger = None
+        self.library = LibraryIndex(self.download_path)
 
         self.added_songs = {}
+        self.pending_batches = iter(())
         self.downloaded_songs = []
+        self.library_songs = []
         self.songs_files = []
         self.wt_link = ''
+        self.resolving = None
+        self.start_time = None
+        self.first_file_time = None
+        self.wall_time = None
+
+    @property
+    def tagger(self):
+        if not self._tagger:
+            from segevmusic.tagger import Tagger
+            self._tagger = Tagger(self.download_path)
+        return self._tagger
+
+    def login(self):
+        """
+        Initializing the Deezer session, if it wasn't initialized yet.
+        If not 'interactive', a failed login raises an error rather than asking for an arl.
+        """
+        if not self.app:
+            from segevmusic.deezr import DeezerFunctions
+            self.app = DeezerFunctions.login(ARL, self.download_path, self.interactive)
+
+    def start_resolving(self):
+        """
+        Starts resolving the added songs' Deezer tracks in the background.
+        """
+        from segevmusic.deezr import DeezerFunctions
+        DeezerFunctions.use_tracks_cache = self.use_cache
+        self.resolving = DeezerFunctions.start_resolving(self.added_songs)
 
     @staticmethod
-    def get_args() -> Namespace:
+    def get_args(argv: List[str] = None) -> Namespace:
         """
-        Get user arguments
+        Get user arguments (or parse the given ones)
         :return: The parsed arguments inside an argparse.Namespace object
         """
         parser = ArgumentParser(prog='segevmusic', description="download music effortlessly")
@@ -47,9 +97,21 @@ class MusicDownloader:
                            type=str)
         parser.add_argument("-x", "--links-file", help="the loaded file contains links", action="store_true",
                             dest='links')
+        parser.add_argument("-j", "--jobs", help="number of songs to download in parallel", type=int)
         parser.add_argument("-d", "--dont-validate", help="don't validate chosen songs",
                             action="store_false", dest='check')
-        args = parser.parse_args()
+        parser.add_argument("--reindex", help="rebuild the library index of the download path and exit",
+                            action="store_true")
+        cache_group = parser.add_mutually_exclusive_group()
+        cache_group.add_argument("--no-cache", help="don't use or update the metadata cache",
+                                 action="store_false", dest='cache')
+        cache_group.add_argument("--refresh", help="ignore cached metadata and fetch it again",
+                                 action="store_true")
+        parser.add_argument("--profile", help="print a profile of the run and write it to a json report",
+                            nargs='?', const=PROFILE_PATH, metavar='REPORT')
+        parser.add_argument("--prometheus", help="write the profile in prometheus text format as well (implies "
+                                                 "--profile)", metavar='FILE')
+        args = parser.parse_args(argv)
         return args
 
     def _add_song(self, song: AMSong, name: str):
@@ -92,11 +154,34 @@ class MusicDownloader:
         """
         This function reads given file lines and adds every song mentioned in the file.
         """
-        for line in get_lines(self.file_path):
-            if self.links:
-                self.get_songs_link(line)
+        self.get_songs_lines(get_lines(self.file_path), self.links)
+
+    def get_songs_lines(self, lines: List[str], links: bool = False):
+        """
+        Adds every song mentioned in the given lines - song names or links.
+        Lines are resolved concurrently, while interactive choosing happens only after
+        all of the lookups are done, in the lines' order.
+        Links of other platforms are converted in a single batch first, and the albums of
+        the chosen songs of song names are fetched together at last.
+        """
+        if links:
+            lines = self._convert_links(lines)
+        resolve = self._resolve_link if links else lambda line: AMFunctions.query_songs(line, add_album=False)
+        unique_lines = list(dict.fromkeys(lines))
+        with ThreadPoolExecutor(max_workers=RESOLVE_WORKERS) as executor:
+            resolved = dict(zip(unique_lines, executor.map(lambda line: self._try_resolve(resolve, line),
+                                                           unique_lines)))
+        results = [resolved[line] for line in lines]
+        chosen_songs = {}
+        for line, songs in zip(lines, results):
+            if links:
+                self._add_songs(songs)
                 continue
-            self._search_song(line)
+            chosen_song = AMFunctions.choose_song(songs, line)
+            if chosen_song:
+                chosen_songs[chosen_song] = line
+        for song in AMFunctions.attach_albums(list(chosen_songs)):
+            self._add_song(song, chosen_songs[song])
 
     def get_songs_album(self):
         album = None
@@ -106,14 +191,64 @@ class MusicDownloader:
             album = AMFunctions.search_album(album_name)
         self._add_songs(album)
 
-    def get_songs_link(self, link: str):
-        if 'apple.com' not in link:
+    @staticmethod
+    def _try_resolve(resolve, line: str) -> List[AMSong]:
+        """
+        Returns the songs resolved from a given line, or an empty list if its
+        lookups kept failing (so a single line doesn't abort the whole list).
+        """
+        try:
+            return resolve(line)
+        except (OSError, ValueError) as e:
+            safe_print(f"--> ERROR: Couldn't look up '{line}': {e}")
+            return []
+
+    @staticmethod
+    def _convert_links(links: List[str]) -> List[str]:
+        """
+        Returns the given links, with links of other platforms converted to
+        Apple Music links (or empty, if their conversion failed).
+        """
+        converted = convert_platform_links(link for link in links if AM_DOMAIN not in link)
+        return [link if AM_DOMAIN in link else converted[link] or '' for link in links]
+
+    @staticmethod
+    def _resolve_item(link: str):
+        """
+        Returns the Apple Music item (song, album or playlist) of a given link, converting
+        it to an Apple Music link first if needed, or None if it wasn't found.
+        """
+        if not link:
+            return None
+        if AM_DOMAIN not in link:
             link = convert_platform_link(link)
             if not link:
                 return None
-        item = AMFunctions.get_item_from_url(link, 'he')
-        songs = [item] if type(item) == AMSong else item
-        self._add_songs(songs)
+        return AMFunctions.get_item_from_url(link, 'he')
+
+    @classmethod
+    def _resolve_link(cls, link: str) -> List[AMSong]:
+        """
+        Returns the songs found in a given link, converting it to an
+        Apple Music link first if needed.
+        """
+        item = cls._resolve_item(link)
+        if not item:
+            return []
+        return [item] if type(item) == AMSong else list(item)
+
+    def get_songs_link(self, link: str):
+        """
+        Adds the songs found in a given link.
+        Only the first page of a playlist's songs is added right away - the rest are
+        loaded while the added songs are downloading.
+        """
+        item = self._resolve_item(link)
+        if isinstance(item, AMPlaylist):
+            self.pending_batches = item.iter_batches()
+            self._add_songs(next(self.pending_batches, []))
+        elif item:
+            self._add_songs([item] if type(item) == AMSong else list(item))
 
     def list_songs(self, to_print=True) -> enumerate:
         enum_songs = enumerate(self.added_songs, start=1)
@@ -139,53 +274,180 @@ class MusicDownloader:
         for bad_index in bad_indexes:
             self._requery(bad_songs[bad_index])
 
-    def _update_downloaded_songs(self):
+    def _skip_library_songs(self, songs: Iterable[AMSong] = None) -> List[AMSong]:
         """
-        Checks which songs are found in the download folder and adds them to the
-        'downloaded_songs' attribute.
+        Returns the given songs (or the added songs) that are not found in the library index yet.
+        Songs that are already in the library are not downloaded again - their
+        library paths are used instead.
         """
-        self.downloaded_songs = [song for song in self.added_songs if
-                                 DeezerFunctions.song_exists(song, self.download_path)]
+        missing_songs = []
+        for song in self.added_songs if songs is None else songs:
+            song_file = self.library.find(song)
+            if not song_file:
+                missing_songs.append(song)
+                continue
+            safe_print(f"--> Already in library: '{song.short_name}'")
+            self.library_songs.append(song)
+            self.songs_files.append(song_file)
+        return missing_songs
+
+    def _skip_not_on_deezer(self, songs: List[AMSong]) -> List[AMSong]:
+        """
+        Waits for the songs' deezer tracks to be resolved, reports the songs that have no
+        matching track on deezer and returns the rest.
+        """
+        from segevmusic.deezr import DeezerFunctions
+        if self.resolving:
+            self.resolving.result()
+        not_found = DeezerFunctions.resolve_songs(songs)
+        for song in not_found:
+            safe_print(f"--> ERROR: Song '{song.short_name}' was not found on Deezer!")
+        return [song for song in songs if song not in not_found]
+
+    def rebuild_library(self):
+        """
+        Rebuilds the library index from the songs found in the download path.
+        """
+        print(f"--> Indexing library at:\n{realpath(self.download_path)}")
+        indexed = self.library.rebuild()
+        print(f"--> Indexed {indexed} songs.")
 
+    @timed('download')
     def download(self):
         """
-        Downloads all of the songs by generating their links
-        and updating downloaded songs afterwards.
+        Downloads all of the songs that are not in the library yet by generating their
+        links. Every song is tagged and renamed as soon as its own download is finished,
+        while the rest are still downloading.
+        Songs of pending batches (the rest of a playlist) join the downloads as soon as they're loaded.
+        Artwork prefetches that are left (of songs that weren't downloaded, or if downloading failed) are cancelled.
+        """
+        from segevmusic.deezr import DeezerFunctions
+        self.start_time = perf_counter()
+        self.login()
+        downloaded = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        finisher = Thread(target=self._finish_songs, args=(downloaded,))
+        finisher.start()
+        try:
+            for song, is_downloaded in DeezerFunctions.iter_download(self._songs_to_download(), self.app, self.jobs):
+                if is_downloaded:
+                    self.downloaded_songs.append(song)
+                    downloaded.put(song)
+        finally:
+            downloaded.put(None)
+            finisher.join()
+            ARTWORK_CACHE.shutdown()
+
+    def _songs_to_download(self) -> Iterator[AMSong]:
+        """
+        Yields the added songs that should be downloaded, and then the songs of every pending batch,
+        as soon as each batch is loaded. Artworks are prefetched meanwhile, so tagging doesn't wait for them.
+        Every ISRC is yielded once, as songs of the same ISRC are downloaded to the same file.
         """
-        DeezerFunctions.download(self.added_songs, self.app)
-        self._update_downloaded_songs()
+        seen_isrcs = set()
+        songs = self._skip_not_on_deezer(self._skip_library_songs(self._unseen(self.added_songs, seen_isrcs)))
+        ARTWORK_CACHE.prefetch(songs)
+        yield from songs
+        for batch in self.pending_batches:
+            batch = self._unseen(batch, seen_isrcs)
+            safe_print(f"--> Loaded {len(batch)} more songs.")
+            self._add_songs(batch)
+            songs = self._skip_not_on_deezer(self._skip_library_songs(batch))
+            ARTWORK_CACHE.prefetch(songs)
+            yield from songs
+
+    @staticmethod
+    def _unseen(songs: Iterable[AMSong], seen_isrcs: set) -> List[AMSong]:
+        """
+        Returns the given songs whose ISRC is not in the given seen ISRCs (keeping only the first song
+        of every ISRC), and adds their ISRCs to it.
+        """
+        unseen_songs = []
+        for song in songs:
+            if song.isrc not in seen_isrcs:
+                seen_isrcs.add(song.isrc)
+                unseen_songs.append(song)
+        return unseen_songs
+
+    def failed_songs(self) -> List[AMSong]:
+        """
+        Returns the added songs that were neither downloaded nor found in the library.
+        """
+        done_isrcs = {song.isrc for song in self.downloaded_songs + self.library_songs}
+        return [song for song in self.added_songs if song.isrc not in done_isrcs]
 
     def _report_not_downloaded(self):
         """
         Prints a message of the songs that weren't downloaded.
         """
-        for failed_song in set(self.added_songs) - set(self.downloaded_songs):
+        for failed_song in self.failed_songs():
             print(f"--> ERROR: Song '{failed_song.short_name}' was not downloaded!")
 
+    def _finish_songs(self, downloaded: Queue):
+        """
+        Tags and renames the songs put in the given queue, until None is put in it.
+        Songs are finished in parallel by the tagging engine.
+        """
+        from segevmusic.tagger import TaggingEngine
+        with TaggingEngine(self.tagger) as engine:
+            for song in iter(downloaded.get, None):
+                try:
+                    future = engine.submit(song)
+                except Exception as e:
+                    safe_print(f"--> ERROR: Failed finishing '{song.short_name}': {e}")
+                    continue
+                future.add_done_callback(lambda finished, song=song: self._song_finished(song, finished))
+
+    def _song_finished(self, song: AMSong, finished: Future):
+        """
+        Handles the tagging result of a song that was tagged and renamed from its ISRC path to
+        a 'good path' - the renamed format is decided in the 'Tagger.generate_good_path' function.
+        """
+        try:
+            result = finished.result()
+        except Exception as e:
+            safe_print(f"--> ERROR: Failed finishing '{song.short_name}': {e}")
+            return None
+        self.tagger.print_errors(song, result)
+        if not result['path']:
+            return None
+        self.library.add(song, result['path'])
+        if self.first_file_time is None:
+            self.first_file_time = perf_counter() - self.start_time
+        self.songs_files.append(result['path'])
+
     def tag(self):
         """
-        Tags all of the downloaded songs.
+        Tags the downloaded songs that are still at their ISRC path.
+        'download' already tags and renames every song as soon as it's downloaded, so this
+        (and 'rename') only does something for songs that were downloaded otherwise.
         """
         for song in self.downloaded_songs:
-            self.tagger.tag_song(song)
+            if exists(self.tagger.generate_isrc_path(song)):
+                self.tagger.tag_song(song)
 
     def rename(self):
         """
         Renames downloaded songs from their ISRC path to a 'good path' - the renamed
         format is decided in the 'Tagger.generate_good_path' function.
+        Songs that were already renamed (by 'download') are skipped.
         """
         for song in self.downloaded_songs:
             try:
                 song_file = self.tagger.rename_isrc_path(song)
             except FileNotFoundError:
                 continue
+            self.library.add(song, song_file)
             self.songs_files.append(song_file)
 
+    @timed('upload')
     def upload(self):
         """
         Uploads all of the downloaded songs to wetransfer.
         """
-        self.wt_link = WTSession().upload(self.songs_files, f"Your {len(self.songs_files)} songs!")
+        if not self.wt_session:
+            from segevmusic.wetransfer import WTSession
+            self.wt_session = WTSession()
+        self.wt_link = self.wt_session.upload(self.songs_files, f"Your {len(self.songs_files)} songs!")
 
     def show_availability(self):
         """
@@ -198,32 +460,63 @@ class MusicDownloader:
             newline()
             print(f"--> Your download is available at:\n{self.wt_link}")
 
-    def download_songs(self, songs: Iterable[AMSong], upload=False):
-        self._add_songs(songs)
-        self.list_songs()
+    def show_timings(self):
+        """
+        Prints how long it took until the first song was ready, and until everything was done.
+        """
+        if self.first_file_time is not None:
+            print(f"--> First song was ready after {self.first_file_time:.2f} seconds.")
+        print(f"--> Everything was done after {self.wall_time:.2f} seconds.")
+
+    def report_profile(self):
+        """
+        Prints the profile of the run and writes its report, if chosen to profile.
+        """
+        if not self.profile_path:
+            return None
+        report = PROFILER.save(self.profile_path, self.prometheus_path)
         newline()
+        print(PROFILER.summary(report))
+        print(f"--> Profile report was written to:\n{realpath(self.profile_path)}")
+
+    def finish(self, upload=False):
+        """
+        Downloads, tags and renames the added songs, uploads them if chosen to
+        and prints their availability.
+        """
         self.download()
         newline()
-        self.tag()
-        self.rename()
         if upload:
             self.upload()
+        self.wall_time = perf_counter() - self.start_time
         newline()
         self.show_availability()
         newline()
+        self.show_timings()
         print("--> DONE!")
 
+    def download_songs(self, songs: Iterable[AMSong], upload=False):
+        self._add_songs(songs)
+        self.start_resolving()
+        self.list_songs()
+        newline()
+        self.finish(upload)
+
     def run(self):
         """
         Runs every function at the right time:
         1) Gets songs interactively/from a file
-        2) Downloads the songs
+        2) Downloads the songs, and as soon as each song is downloaded:
         3) Tags the metadata
         4) Renames the songs paths to human-convenient paths.
         5) Uploads the songs to wetransfer if the option was chosen
         6) Prints songs availability
         7) Alerts when finished
+        8) Reports the run's profile if chosen to
         """
+        if self.reindex:
+            self.rebuild_library()
+            return None
         if self.file_path:
             self.get_songs_file()
         elif self.all_album:
@@ -232,21 +525,14 @@ class MusicDownloader:
             self.get_songs_link(self.link)
         else:
             self.get_songs_interactive()
+        self.start_resolving()
         newline()
         self.list_songs()
         if self.to_check:
             self.offer_fix()
         newline()
-        self.download()
-        newline()
-        self.tag()
-        self.rename()
-        if self.to_upload:
-            self.upload()
-        newline()
-        self.show_availability()
-        newline()
-        print("--> DONE!")
+        self.finish(self.to_upload)
+        self.report_profile()
 
 
 def main():
@@ -1,3 +1,4 @@
+from segevmusic.utils import safe_print
 import deemix.utils.localpaths as localpaths
 from deezer import TrackFormats
 from deemix.settings import OverwriteOption, FeaturesOption
@@ -97,4 +98,4 @@ class LogListener:
             if any(WANTED_LOG_KEYS.intersection(set(value))):
                 log_string = formatListener(key, value)
                 if log_string:
-                    print(log_string)
+                    safe_print(log_string)
@@ -0,0 +1,197 @@
+from threading import Lock
+from time import perf_counter
+from functools import wraps
+from urllib.parse import urlsplit
+from json import dump
+from typing import List
+
+PROFILE_PATH = 'segevmusic-profile.json'
+QUANTILES = (0.5, 0.9, 0.99)
+METRICS_PREFIX = 'segevmusic'
+
+
+def percentile(sorted_samples: List[float], quantile: float) -> float:
+    """
+    Returns the given quantile of already sorted samples (by the nearest rank), or 0 if there are none.
+    """
+    if not sorted_samples:
+        return 0.0
+    rank = min(int(quantile * len(sorted_samples)), len(sorted_samples) - 1)
+    return sorted_samples[rank]
+
+
+def summarize(samples: List[float]) -> dict:
+    """
+    Returns the count, total, mean, max and percentiles of the given durations.
+    """
+    samples = sorted(samples)
+    total = sum(samples)
+    summary = {
+        'count': len(samples),
+        'total': total,
+        'mean': total / len(samples) if samples else 0.0,
+        'max': samples[-1] if samples else 0.0
+    }
+    summary.update({f"p{int(quantile * 100)}": percentile(samples, quantile) for quantile in QUANTILES})
+    return summary
+
+
+class Profiler:
+    """
+    Timers of the hot paths (stages), named counters and per host HTTP calls, bytes and
+    latencies, collected only while enabled. Timers are thread safe, and may be nested.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.counters = {}
+        self.hosts = {}
+        self._lock = Lock()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {}
+            self.hosts = {}
+
+    def add_time(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages.setdefault(stage, []).append(seconds)
+
+    def count(self, counter: str, value: float = 1):
+        if not self.enabled:
+            return None
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def timed(self, stage: str):
+        """
+        A decorator timing every call of the decorated function as the given stage.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.add_time(stage, perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def record_response(self, response, *args, **kwargs):
+        """
+        A requests response hook, recording the host, latency (until the headers arrived)
+        and sent and received bytes of every response.
+        Received bytes are taken from the Content-Length header, as the body isn't read yet.
+        """
+        if not self.enabled:
+            return None
+        request = response.request
+        body = request.body if request is not None else None
+        sent = len(body) if body is not None and hasattr(body, '__len__') else 0
+        received = int(response.headers.get('Content-Length') or 0)
+        host = urlsplit(response.url).hostname or ''
+        with self._lock:
+            host_stats = self.hosts.setdefault(host, {
+                'requests': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0, 'latencies': []
+            })
+            host_stats['requests'] += 1
+            host_stats['errors'] += response.status_code >= 400
+            host_stats['bytes_sent'] += sent
+            host_stats['bytes_received'] += received
+            host_stats['latencies'].append(response.elapsed.total_seconds())
+
+    def report(self) -> dict:
+        """
+        Returns the summary of every stage, every counter and every host's HTTP calls,
+        along with the rate limiter's and transport's per host counters.
+        """
+        from segevmusic.limiter import LIMITER_STATS
+        from segevmusic.transport import TRANSPORT_STATS
+        with self._lock:
+            stages = {stage: summarize(samples) for stage, samples in self.stages.items()}
+            counters = dict(self.counters)
+            hosts = {
+                host: dict({key: value for key, value in stats.items() if key != 'latencies'},
+                           latency=summarize(stats['latencies']))
+                for host, stats in self.hosts.items()
+            }
+        return {
+            'stages': stages,
+            'counters': counters,
+            'http': hosts,
+            'limiter': LIMITER_STATS.report(),
+            'transport': TRANSPORT_STATS.report()
+        }
+
+    @staticmethod
+    def summary(report: dict) -> str:
+        """
+        Returns a human readable summary of a given report.
+        """
+        lines = ["--> Profile:", f"{'stage':<20}{'calls':>8}{'total':>10}{'mean':>9}{'p90':>9}{'max':>9}"]
+        for stage, stats in sorted(report['stages'].items(), key=lambda item: -item[1]['total']):
+            lines.append(f"{stage:<20}{stats['count']:>8}{stats['total']:>9.2f}s{stats['mean']:>8.3f}s"
+                         f"{stats['p90']:>8.3f}s{stats['max']:>8.3f}s")
+        if report['http']:
+            lines.append(f"{'host':<28}{'calls':>7}{'errors':>8}{'sent':>10}{'received':>10}{'p50':>9}{'p99':>9}")
+        for host, stats in sorted(report['http'].items(), key=lambda item: -item[1]['requests']):
+            lines.append(f"{host:<28}{stats['requests']:>7}{stats['errors']:>8}"
+                         f"{stats['bytes_sent'] / 1024:>8.0f}KB{stats['bytes_received'] / 1024:>8.0f}KB"
+                         f"{stats['latency']['p50']:>8.3f}s{stats['latency']['p99']:>8.3f}s")
+        for counter, value in sorted(report['counters'].items()):
+            lines.append(f"{counter}: {value}")
+        return '\n'.join(lines)
+
+    @staticmethod
+    def prometheus(report: dict) -> str:
+        """
+        Returns a given report in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def summary_metric(name: str, label: str, summaries: dict, help_text: str):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} summary"])
+            for value, stats in summaries.items():
+                for quantile in QUANTILES:
+                    lines.append(f'{name}{{{label}="{value}",quantile="{quantile}"}} '
+                                 f'{stats[f"p{int(quantile * 100)}"]}')
+                lines.append(f'{name}_sum{{{label}="{value}"}} {stats["total"]}')
+                lines.append(f'{name}_count{{{label}="{value}"}} {stats["count"]}')
+
+        def counter_metric(name: str, label: str, values: dict, help_text: str):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} counter"])
+            lines.extend(f'{name}{{{label}="{key}"}} {value}' for key, value in values.items())
+
+        hosts = report['http']
+        summary_metric(f"{METRICS_PREFIX}_stage_seconds", 'stage', report['stages'], "Wall time of every stage.")
+        counter_metric(f"{METRICS_PREFIX}_events_total", 'name', report['counters'], "Counted events.")
+        summary_metric(f"{METRICS_PREFIX}_http_latency_seconds", 'host',
+                       {host: stats['latency'] for host, stats in hosts.items()}, "HTTP latency per host.")
+        for counter, help_text in (('requests', "HTTP calls per host."), ('errors', "HTTP error responses per host."),
+                                   ('bytes_sent', "HTTP bytes sent per host."),
+                                   ('bytes_received', "HTTP bytes received per host.")):
+            counter_metric(f"{METRICS_PREFIX}_http_{counter}_total", 'host',
+                           {host: stats[counter] for host, stats in hosts.items()}, help_text)
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path: str = PROFILE_PATH, prometheus_path: str = None) -> dict:
+        """
+        Writes the report to a given json file (and in the Prometheus format to a given file,
+        if given), and returns it.
+        """
+        report = self.report()
+        with open(path, 'w') as f:
+            dump(report, f, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, 'w') as f:
+                f.write(self.prometheus(report))
+        return report
+
+
+PROFILER = Profiler()
+timed = PROFILER.timed
@@ -0,0 +1,248 @@
+from segevmusic.music_downloader import MusicDownloader
+from segevmusic.cache import CACHE_DIR
+from segevmusic.utils import safe_print
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+from argparse import ArgumentParser, Namespace
+from threading import Thread, Event, Lock
+from queue import PriorityQueue
+from itertools import count
+from os import remove, makedirs
+from os.path import join, exists, dirname, realpath
+from json import loads, dumps
+from typing import List
+import socket
+
+SERVER_SOCKET_PATH = join(CACHE_DIR, 'server.sock')
+DEFAULT_PRIORITY = 0
+
+
+def _strings(json: dict, field: str) -> List[str]:
+    """
+    Returns a given job field that should be a list of strings, or raises a ValueError.
+    """
+    values = json.get(field, [])
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        raise ValueError(f"'{field}' should be a list of strings")
+    return values
+
+
+def _integer(json: dict, field: str, default: int = None, minimum: int = None) -> int or None:
+    """
+    Returns a given job field that should be an integer (of at least 'minimum'), or raises a ValueError.
+    """
+    value = json.get(field, default)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, int) or (minimum is not None and value < minimum):
+        raise ValueError(f"'{field}' should be an integer" + (f" of at least {minimum}" if minimum is not None else ''))
+    return value
+
+
+class Job:
+    """
+    A download job - links, search terms and files of songs to download.
+    Raises a ValueError if the job's fields are invalid.
+    """
+
+    def __init__(self, job_id: int, json: dict):
+        if not isinstance(json, dict):
+            raise ValueError("a job should be a json object")
+        self.id = job_id
+        self.links = _strings(json, 'links')
+        self.terms = _strings(json, 'terms')
+        self.files = _strings(json, 'files')
+        self.links_files = bool(json.get('links_file', False))
+        self.path = json.get('path', './Songs')
+        if not isinstance(self.path, str):
+            raise ValueError("'path' should be a string")
+        self.upload = bool(json.get('upload', False))
+        self.jobs = _integer(json, 'jobs', minimum=1)
+        self.priority = _integer(json, 'priority', DEFAULT_PRIORITY)
+        self.result = {'id': job_id, 'status': 'queued'}
+        self.done = Event()
+
+    def to_args(self) -> Namespace:
+        """
+        Returns the job as MusicDownloader arguments.
+        """
+        argv = [self.path, '--dont-validate']
+        if self.upload:
+            argv.append('--upload')
+        if self.jobs:
+            argv += ['--jobs', str(self.jobs)]
+        return MusicDownloader.get_args(argv)
+
+
+class JobServer(ThreadingUnixStreamServer):
+    """
+    A long-running server that runs download jobs from a local (Unix socket) queue, one at a time,
+    by their priority. Deezer and WeTransfer sessions, and every metadata cache, stay warm between jobs.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str = SERVER_SOCKET_PATH):
+        makedirs(dirname(socket_path), exist_ok=True)
+        if exists(socket_path):
+            remove(socket_path)
+        super().__init__(socket_path, JobHandler)
+        self.socket_path = socket_path
+        self.jobs = PriorityQueue()
+        self._ids = count(1)
+        self._ids_lock = Lock()
+        self.apps = {}
+        self.wt_session = None
+        self.worker = Thread(target=self.run_jobs, daemon=True)
+
+    def submit(self, json: dict) -> Job:
+        """
+        Queues a job. Jobs with a higher priority run first, and jobs with
+        the same priority run in their submission order.
+        Raises a ValueError if the job is invalid.
+        """
+        with self._ids_lock:
+            job = Job(next(self._ids), json)
+        self.jobs.put((-job.priority, job.id, job))
+        return job
+
+    def run_jobs(self):
+        while True:
+            _, _, job = self.jobs.get()
+            job.result['status'] = 'running'
+            try:
+                job.result.update(self.run_job(job))
+                job.result['status'] = 'done'
+            except BaseException as e:
+                # Anything (even a SystemExit) must not stop the worker, or no job would run again:
+                job.result.update({'status': 'failed', 'error': str(e) or type(e).__name__})
+            safe_print(f"--> Job {job.id} {job.result['status']}.")
+            job.done.set()
+
+    def run_job(self, job: Job) -> dict:
+        """
+        Runs a given job with a MusicDownloader that reuses the server's warm sessions.
+        Albums, genre lookups, the Apple Music API token and resolved tracks of former jobs are
+        forgotten first (cached responses are kept), so they don't pile up or go stale.
+        The job fails rather than asking for a Deezer arl if logging in fails.
+        Returns the job's results.
+        """
+        from segevmusic.applemusic import AMFunctions
+        from segevmusic.deezr import DeezerFunctions
+        AMFunctions.reset_registries()
+        DeezerFunctions.forget_tracks()
+        downloader = MusicDownloader(job.to_args())
+        downloader.interactive = False
+        downloader.app = self.apps.get(realpath(job.path))
+        downloader.wt_session = self.wt_session
+        downloader.get_songs_lines(job.links, links=True)
+        downloader.get_songs_lines(job.terms)
+        for file in job.files:
+            downloader.file_path = file
+            downloader.links = job.links_files
+            downloader.get_songs_file()
+        downloader.start_resolving()
+        downloader.finish(job.upload)
+        self.apps[realpath(job.path)] = downloader.app
+        self.wt_session = downloader.wt_session
+        return {
+            'files': downloader.songs_files,
+            'failed': [song.short_name for song in downloader.failed_songs()],
+            'in_library': [song.short_name for song in downloader.library_songs],
+            'link': downloader.wt_link
+        }
+
+    def serve(self):
+        self.worker.start()
+        safe_print(f"--> Waiting for jobs at {self.socket_path}")
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            remove(self.socket_path)
+
+
+class JobHandler(StreamRequestHandler):
+    """
+    Handles a single client request - a json line with the job.
+    Replies with a json line of the queued job, and another line with its results
+    once it's done if the client asked to wait for it.
+    """
+
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline())
+            job = self.server.submit(request)
+        except ValueError as e:
+            self.reply({'status': 'rejected', 'error': str(e)})
+            return None
+        self.reply(job.result)
+        if request.get('wait'):
+            job.done.wait()
+            self.reply(job.result)
+
+    def reply(self, json: dict):
+        self.wfile.write(dumps(json).encode() + b'\n')
+        self.wfile.flush()
+
+
+def submit(job: dict, socket_path: str = SERVER_SOCKET_PATH) -> List[dict]:
+    """
+    Sends a job to a running server.
+    Returns the server's replies.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(dumps(job).encode() + b'\n')
+        with client.makefile('rb') as replies:
+            return [loads(reply) for reply in replies]
+
+
+def get_args() -> Namespace:
+    parser = ArgumentParser(prog='segevmusic-server', description="run segevmusic jobs from a warm server")
+    parser.add_argument("-s", "--socket", help="the server's socket path", default=SERVER_SOCKET_PATH)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser("serve", help="run the server")
+    client = commands.add_parser("submit", help="submit a job to a running server")
+    client.add_argument("path", help="songs download path", nargs='?', default='./Songs')
+    client.add_argument("-l", "--link", help="a link of playlists, albums or songs", action='append', default=[],
+                        dest='links')
+    client.add_argument("-t", "--term", help="a song name (+ artist) to search", action='append', default=[],
+                        dest='terms')
+    client.add_argument("-f", "--file", help="a file with songs list", action='append', default=[], dest='files')
+    client.add_argument("-x", "--links-file", help="the loaded files contain links", action="store_true",
+                        dest='links_file')
+    client.add_argument("-u", "--upload", help="upload songs to wetransfer", action="store_true")
+    client.add_argument("-j", "--jobs", help="number of songs to download in parallel", type=int)
+    client.add_argument("-p", "--priority", help="job priority (higher runs first)", type=int,
+                        default=DEFAULT_PRIORITY)
+    client.add_argument("-w", "--wait", help="wait for the job to finish", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    """
+    For entry points.
+    """
+    args = get_args()
+    if args.command == 'serve':
+        JobServer(args.socket).serve()
+        return None
+    job = {
+        'links': args.links,
+        'terms': args.terms,
+        'files': [realpath(file) for file in args.files],
+        'links_file': args.links_file,
+        'path': realpath(args.path),
+        'upload': args.upload,
+        'jobs': args.jobs,
+        'priority': args.priority,
+        'wait': args.wait
+    }
+    for reply in submit(job, args.socket):
+        print(dumps(reply, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,86 @@
-from segevmusic.applemusic import AMSong
+from segevmusic.applemusic import AMSong, ARTWORK_CACHE
+from segevmusic.utils import safe_print
+from segevmusic.profiler import PROFILER, timed
 from mutagen.id3 import ID3, TXXX, TIT2, TPE1, TALB, TPE2, TCON, TPUB, TSRC, APIC, TCOP, TDRC, TRCK, TPOS
-from os import replace
+from os import replace, cpu_count
 from os.path import realpath, join
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, Future
+from multiprocessing import get_context
+from time import perf_counter
 from typing import List
 
-TAGS = {
-    "song_name": lambda amsong: TIT2(text=amsong.name),
-    "album_name": lambda amsong: TALB(text=amsong.album_name),
-    "isrc": lambda amsong: TSRC(text=amsong.isrc),
-    "record_label": lambda amsong: TPUB(text=amsong.album.record_label) if amsong.album.record_label else None,
-    "copyright": lambda amsong: TCOP(text=amsong.album.copyright),
-    "genre": lambda amsong: TCON(text=amsong.genres[0]),
-    "album_artist": lambda amsong: TPE2(text=amsong.album.artist_name),
-    "song_artist": lambda amsong: TPE1(text=amsong.artist_name),
-    "itunes_advisory": lambda amsong: TXXX(desc="ITUNESADVISORY", text="1") if amsong.is_explicit else None,
-    "release_date": lambda amsong: TDRC(text=amsong.release_date),
-    "artwork": lambda amsong: APIC(mime='image/jpeg', desc='cover', data=amsong.get_artwork(prefer_album=True)),
-    "disc_position": lambda amsong: TPOS(text=amsong.disc_number) if '/' in str(amsong.disc_number) else None,
-    "track_position": lambda amsong: TRCK(text=f"{amsong.track_number}/{amsong.album.track_count}")
+TAG_VALUES = {
+    "song_name": lambda amsong: amsong.name,
+    "album_name": lambda amsong: amsong.album_name,
+    "isrc": lambda amsong: amsong.isrc,
+    "record_label": lambda amsong: amsong.album.record_label or None,
+    "copyright": lambda amsong: amsong.album.copyright,
+    "genre": lambda amsong: amsong.genres[0],
+    "album_artist": lambda amsong: amsong.album.artist_name,
+    "song_artist": lambda amsong: amsong.artist_name,
+    "itunes_advisory": lambda amsong: "1" if amsong.is_explicit else None,
+    "release_date": lambda amsong: amsong.release_date,
+    "artwork": lambda amsong: amsong.get_artwork(prefer_album=True),
+    "disc_position": lambda amsong: amsong.disc_number if '/' in str(amsong.disc_number) else None,
+    "track_position": lambda amsong: f"{amsong.track_number}/{amsong.album.track_count}"
+}
+TAG_FRAMES = {
+    "song_name": lambda value: TIT2(text=value),
+    "album_name": lambda value: TALB(text=value),
+    "isrc": lambda value: TSRC(text=value),
+    "record_label": lambda value: TPUB(text=value),
+    "copyright": lambda value: TCOP(text=value),
+    "genre": lambda value: TCON(text=value),
+    "album_artist": lambda value: TPE2(text=value),
+    "song_artist": lambda value: TPE1(text=value),
+    "itunes_advisory": lambda value: TXXX(desc="ITUNESADVISORY", text=value),
+    "release_date": lambda value: TDRC(text=value),
+    "artwork": lambda value: APIC(mime='image/jpeg', desc='cover', data=value),
+    "disc_position": lambda value: TPOS(text=value),
+    "track_position": lambda value: TRCK(text=value)
 }
 ERROR_MSG = "--> For '{song}' failed tagging: {tags}"
+TAGGING_WORKERS = cpu_count() or 1
+
+
+def tag_file(job: dict) -> dict:
+    """
+    Tags a single song file with the given plain tag values and renames it to its 'good' path
+    (if there's one), as one unit of work - so it can run in a worker process.
+    Returns the song's new path (or None if its file was not found), the tags that failed
+    and a mutagen error message, if its file couldn't be read.
+    """
+    result = {'path': None, 'errors': list(job['errors']), 'error': None}
+    try:
+        id3 = ID3(job['isrc_path'])
+    except Exception as e:
+        result['error'] = f"Internal mutagen exception: {e}"
+    else:
+        for key, value in job['values'].items():
+            try:
+                id3.add(TAG_FRAMES[key](value))
+            except Exception:
+                result['errors'].append(key)
+        id3.save(v1=2, v2_version=3, v23_sep='/')
+    if not job['good_path']:
+        result['path'] = job['isrc_path']
+        return result
+    try:
+        replace(job['isrc_path'], job['good_path'])
+    except FileNotFoundError:
+        return result
+    result['path'] = job['good_path']
+    return result
+
+
+def timed_tag_file(job: dict) -> dict:
+    """
+    Runs 'tag_file' with a given job, and adds how long it took to its result (as 'time').
+    """
+    start = perf_counter()
+    result = tag_file(job)
+    result['time'] = perf_counter() - start
+    return result
 
 
 class Tagger:
@@ -30,28 +91,43 @@ class Tagger:
     def __init__(self, path):
         self.path = realpath(path)
 
+    @timed('tagging_job')
+    def tagging_job(self, song: AMSong) -> dict:
+        """
+        Returns the plain data needed for tagging and renaming the given song - its paths and
+        tag values (without the tags it doesn't have, and the names of the tags that failed).
+        A running prefetch of the song's artwork is waited for, rather than downloading it again.
+        """
+        ARTWORK_CACHE.wait_prefetch(song)
+        values = {}
+        errors = []
+        for key, get_value in TAG_VALUES.items():
+            try:
+                value = get_value(song)
+            except Exception:
+                errors.append(key)
+                continue
+            if value is not None:
+                values[key] = value
+        return {
+            'isrc_path': self.generate_isrc_path(song),
+            'good_path': self.generate_good_path(song),
+            'values': values,
+            'errors': errors
+        }
+
+    @timed('tag_song')
     def tag_song(self, song: AMSong):
         """
-        Tags ID3 metadata using the TAGS constant and saves changes.
+        Tags ID3 metadata using the TAG_VALUES and TAG_FRAMES constants and saves changes.
         Prints errors afterwards
         :param song:
         :return:
         """
-        file_path = self.generate_isrc_path(song)
-        try:
-            id3 = ID3(file_path)
-        except Exception as e:
-            print(f"--> ERROR: Internal mutagen exception: {e}")
-            return None
-        errors = []
-        for key, tag in TAGS.items():
-            try:
-                id3_tag = tag(song)
-                if id3_tag:
-                    id3.add(id3_tag)
-            except:
-                errors.append(key)
-        id3.save(v1=2, v2_version=3, v23_sep='/')
+        job = self.tagging_job(song)
+        job['good_path'] = None
+        result = tag_file(job)
+        self.print_errors(song, result)
 
     def rename_isrc_path(self, amsong: AMSong) -> str:
         """
@@ -75,6 +151,15 @@ class Tagger:
         """
         return join(self.path, f"{amsong.artist_name} - {amsong.name}.mp3")
 
+    @classmethod
+    def print_errors(cls, song: AMSong, result: dict):
+        """
+        Prints the errors of a given song's tagging result.
+        """
+        if result['error']:
+            safe_print(f"--> ERROR: {result['error']}")
+        cls._print_errors(song, result['errors'])
+
     @staticmethod
     def _print_errors(song: AMSong, errors: List[str]):
         """
@@ -82,4 +167,55 @@ class Tagger:
         the iTunes Advisory tag.
         """
         if errors:
-            print(ERROR_MSG.format(song=song.short_name, tags=errors))
+            safe_print(ERROR_MSG.format(song=song.short_name, tags=errors))
+
+
+class TaggingEngine:
+    """
+    Tags and renames songs on several cores - the songs' tag values are gathered in the
+    calling thread, and every file is then tagged and renamed by a worker process.
+    """
+
+    def __init__(self, tagger: Tagger, workers: int = TAGGING_WORKERS):
+        self.tagger = tagger
+        self.workers = workers
+        self._executor = None
+
+    @property
+    def executor(self) -> Executor:
+        if not self._executor:
+            if self.workers > 1:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def submit(self, song: AMSong) -> Future:
+        """
+        Starts tagging and renaming the given song.
+        Returns a future of its tagging result (see 'tag_file').
+        The time every file took in its worker is profiled as the 'tag_file' stage.
+        """
+        future = self.executor.submit(timed_tag_file, self.tagger.tagging_job(song))
+        if PROFILER.enabled:
+            future.add_done_callback(self._profile_tag_file)
+        return future
+
+    @staticmethod
+    def _profile_tag_file(finished: Future):
+        if not finished.exception():
+            PROFILER.add_time('tag_file', finished.result()['time'])
+
+    def close(self):
+        """
+        Waits for every submitted song to be finished.
+        """
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,123 @@
+from threading import Lock
+from time import perf_counter
+from urllib.parse import urlsplit
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from segevmusic.profiler import PROFILER
+
+POOL_HOSTS = 16
+POOL_CONNECTIONS_PER_HOST = 8
+DEFAULT_TIMEOUT = (10, 30)
+
+
+class TransportStats:
+    """
+    Per host counters of requests, opened connections and the time spent opening
+    them (TCP + TLS handshakes). Requests that didn't open a connection reused one.
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self._lock = Lock()
+
+    def _host(self, host: str) -> dict:
+        return self.hosts.setdefault(host, {'requests': 0, 'connections': 0, 'handshake_time': 0.0})
+
+    def request(self, url: str):
+        with self._lock:
+            self._host(urlsplit(url).hostname or '')['requests'] += 1
+
+    def connection(self, host: str, handshake_time: float):
+        with self._lock:
+            host_stats = self._host(host.lower())
+            host_stats['connections'] += 1
+            host_stats['handshake_time'] += handshake_time
+
+    def report(self) -> dict:
+        """
+        Returns the counters of every host, including how many requests reused a connection.
+        """
+        with self._lock:
+            return {
+                host: dict(stats, reused=max(stats['requests'] - stats['connections'], 0))
+                for host, stats in self.hosts.items()
+            }
+
+
+TRANSPORT_STATS = TransportStats()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = perf_counter()
+        super().connect()
+        TRANSPORT_STATS.connection(self.host, perf_counter() - start)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = perf_counter()
+        super().connect()
+        TRANSPORT_STATS.connection(self.host, perf_counter() - start)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    An adapter keeping a pool of keep-alive connections per host, which counts
+    every connection it opens in TRANSPORT_STATS.
+    """
+
+    def __init__(self, hosts: int = POOL_HOSTS, connections_per_host: int = POOL_CONNECTIONS_PER_HOST):
+        super().__init__(pool_connections=hosts, pool_maxsize=connections_per_host)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool
+        }
+
+
+class TransportSession(Session):
+    """
+    A requests session shared by every metadata and artwork request,
+    with pooled keep-alive connections and a default timeout.
+    Every response is recorded by the profiler (when it's enabled).
+    """
+
+    def __init__(self):
+        super().__init__()
+        adapter = PooledAdapter()
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.hooks['response'].append(PROFILER.record_response)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+        TRANSPORT_STATS.request(url)
+        return super().request(method, url, *args, **kwargs)
+
+
+_session = None
+_session_lock = Lock()
+
+
+def session() -> TransportSession:
+    """
+    Returns the shared transport session.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = TransportSession()
+        return _session
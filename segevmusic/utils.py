@@ -1,12 +1,19 @@
-from typing import List
-from requests import get
-from urllib.parse import quote
+from typing import List, Dict, Iterable
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from segevmusic.fetcher import get_json
+from urllib.parse import quote, urlsplit, urlunsplit, parse_qsl, urlencode
 from re import search
 
 BOOL_DICT = {'y': True, 'Y': True, 'yes': True, 'Yes': True, '': True,
              'n': False, 'N': False, 'no': False, 'No': False}
 
 ODESLI_URL = "https://api.song.link/v1-alpha.1/links?url={url}"
+ODESLI_CONCURRENCY = 2
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'igshid', 'context', 'nd'}
+TRACKING_PARAMS_PREFIXES = ('utm_',)
+
+_print_lock = Lock()
 
 
 def ask(question: str, bool_dict: dict = BOOL_DICT, on_interrupt=False):
@@ -73,17 +80,53 @@ def newline():
     print("\n", end='')
 
 
+def safe_print(*args, **kwargs):
+    """
+    Prints the given arguments, without interleaving with other threads' output.
+    """
+    with _print_lock:
+        print(*args, **kwargs, flush=True)
+
+
 def convert_platform_link(link: str, wanted_platform: str = "appleMusic"):
     url = quote(link)
-    json = get(ODESLI_URL.format(url=url)).json()
     try:
+        json = get_json(ODESLI_URL.format(url=url))
         converted_url = json['linksByPlatform'][wanted_platform]['url']
-    except KeyError:
+    except (KeyError, ValueError, OSError):
         print("--> ERROR: Conversion failed; Try a different URL or search manually.")
         return None
     return converted_url
 
 
+def normalize_link(link: str) -> str:
+    """
+    Returns the given link without surrounding whitespace, tracking parameters and
+    a fragment, and with a lower-cased scheme and host - so different shares of
+    the same item are recognized as the same link.
+    """
+    parts = urlsplit(link.strip())
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if key not in TRACKING_PARAMS and not key.startswith(TRACKING_PARAMS_PREFIXES)]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+
+def convert_platform_links(links: Iterable[str], wanted_platform: str = "appleMusic",
+                           workers: int = ODESLI_CONCURRENCY) -> Dict[str, str]:
+    """
+    Converts the given links, normalized and de-duplicated, with up to 'workers'
+    concurrent requests.
+    Returns a dict of every given link and its converted link (or None if conversion failed).
+    """
+    links = list(links)
+    normalized_links = {link: normalize_link(link) for link in links}
+    unique_links = list(dict.fromkeys(normalized_links.values()))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        converted = dict(zip(unique_links, executor.map(lambda link: convert_platform_link(link, wanted_platform),
+                                                        unique_links)))
+    return {link: converted[normalized_links[link]] for link in links}
+
+
 def get_url_param_value(url: str, param: str):
     re_match = search(r"[?&](" + param + "=[^&]+).*$", url)
     if re_match:
@@ -104,3 +147,11 @@ def update_url_param(url: str, param: str, value: str):
     else:
         new_url = url + f'&{param_value}'
     return new_url
+
+
+def remove_url_param(url: str, param: str):
+    re_match = search(r"([?&])" + param + "=[^&]*&?", url)
+    if not re_match:
+        return url
+    separator = re_match.group(1) if re_match.group(0).endswith('&') else ''
+    return (url[:re_match.start()] + separator + url[re_match.end():]).rstrip('?&')
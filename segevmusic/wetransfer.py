@@ -1,10 +1,17 @@
-from typing import List
+from segevmusic.cache import CACHE_DIR
+from segevmusic.profiler import PROFILER, timed
+from typing import List, Set
 from re import search
+from json import load, dump, dumps
+from hashlib import sha256
 from zlib import crc32
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from mmap import mmap, ACCESS_READ
 import requests
 import os.path
 from math import ceil
-from sys import stdout
 
 WETRANSFER_URL = 'https://wetransfer.com/'
 WETRANSFER_API_URL = WETRANSFER_URL + 'api/v4/transfers'
@@ -14,12 +21,139 @@ WETRANSFER_PART_PUT_URL = WETRANSFER_FILES_URL + '/{file_id}/part-put-url'
 WETRANSFER_FINALIZE_MPP_URL = WETRANSFER_FILES_URL + '/{file_id}/finalize-mpp'
 WETRANSFER_FINALIZE_URL = WETRANSFER_API_URL + '/{transfer_id}/finalize'
 WETRANSFER_DEFAULT_CHUNK_SIZE = 5242880
+WETRANSFER_UPLOAD_WORKERS = 4
+WETRANSFER_JOURNALS_DIR = os.path.join(CACHE_DIR, 'wetransfer-journals')
+JOURNAL_SAVE_CHUNKS = 16
 
 PUT_JSON = {
     'Origin': WETRANSFER_URL,
     'Access-Control-Request-Method': 'PUT'
 }
 CSRF_REGEX = 'name="csrf-token" content="([^"]+)"'
+REJECTED_STATUSES = (404, 410)
+SESSION_EXPIRED_STATUSES = (401, 403)
+
+
+class TransferRejected(Exception):
+    """
+    Raised when WeTransfer no longer has a transfer (it expired or was deleted),
+    so the transfer can't be resumed.
+    """
+
+
+class UploadJournal:
+    """
+    An on-disk record of an upload in progress - its transfer_id, every file's file_id
+    and the chunks that were already acknowledged - so a failed upload can be resumed.
+    Every upload (of its own files and message) has its own journal file in the given directory,
+    so concurrent uploads don't overwrite each other's journals.
+    Acknowledged chunks are saved every 'save_chunks' chunks (and when the upload fails) rather
+    than after every chunk.
+    """
+
+    def __init__(self, directory: str = WETRANSFER_JOURNALS_DIR, save_chunks: int = JOURNAL_SAVE_CHUNKS):
+        self.directory = directory
+        self.save_chunks = save_chunks
+        self.path = None
+        self.data = {}
+        self._unsaved_chunks = 0
+        self._lock = Lock()
+
+    def journal_path(self, files_state: dict, message: str) -> str:
+        """
+        Returns the journal file path of an upload of the given files (state) and message.
+        """
+        key = sha256(dumps([files_state, message], sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+
+    @staticmethod
+    def _files_state(files: List[str], stats: dict) -> dict:
+        return {
+            os.path.realpath(f): {
+                'size': stats[f].st_size,
+                'mtime': stats[f].st_mtime
+            } for f in files
+        }
+
+    def resume(self, files: List[str], stats: dict, message: str) -> str or None:
+        """
+        Loads the journal of the given files and message, and returns its transfer_id if it records
+        an upload of the same (unchanged) files with the same message, or None otherwise.
+        """
+        files_state = self._files_state(files, stats)
+        path = self.journal_path(files_state, message)
+        try:
+            with open(path) as f:
+                data = load(f)
+        except (OSError, ValueError):
+            return None
+        journal_state = {path: {'size': entry['size'], 'mtime': entry['mtime']}
+                         for path, entry in data.get('files', {}).items()}
+        if data.get('message') != message or journal_state != files_state:
+            return None
+        self.path = path
+        self.data = data
+        return data['transfer_id']
+
+    def start(self, transfer_id: str, files: List[str], stats: dict, message: str):
+        """
+        Starts recording a new upload of the given files.
+        """
+        files_state = self._files_state(files, stats)
+        self.path = self.journal_path(files_state, message)
+        self.data = {
+            'transfer_id': transfer_id,
+            'message': message,
+            'files': files_state
+        }
+        for entry in self.data['files'].values():
+            entry.update({'file_id': None, 'chunks': [], 'finalized': False})
+        self.save()
+
+    def file(self, file: str) -> dict:
+        return self.data['files'][os.path.realpath(file)]
+
+    def uploaded_chunks(self, file: str) -> Set[int]:
+        return set(self.file(file)['chunks'])
+
+    def update_file(self, file: str, **values):
+        with self._lock:
+            self.file(file).update(values)
+            self._save()
+
+    def add_chunk(self, file: str, chunk_number: int):
+        with self._lock:
+            self.file(file)['chunks'].append(chunk_number)
+            self._unsaved_chunks += 1
+            if self._unsaved_chunks >= self.save_chunks:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            dump(self.data, f)
+        os.replace(temp_path, self.path)
+        self._unsaved_chunks = 0
+
+    def remove(self):
+        """
+        Removes the journal, once its upload was finalized.
+        """
+        path, self.path = self.path, None
+        self.data = {}
+        if not path:
+            return None
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
 class WTSession(requests.Session):
@@ -27,11 +161,18 @@ class WTSession(requests.Session):
     A class for handling WeTransfer sessions.
     """
 
-    def __init__(self):
+    def __init__(self, upload_workers: int = WETRANSFER_UPLOAD_WORKERS, journals_dir: str = WETRANSFER_JOURNALS_DIR):
         super().__init__()
+        self.hooks['response'].append(PROFILER.record_response)
         self.prepare_session()
         self.total_chunks = 0
         self.current_chunk = 0
+        self.upload_workers = upload_workers
+        self.parts_session = requests.Session()
+        self.parts_session.mount('https://', HTTPAdapter(pool_maxsize=upload_workers))
+        self.parts_session.hooks['response'].append(PROFILER.record_response)
+        self._progress_lock = Lock()
+        self.journal = UploadJournal(journals_dir)
 
     def prepare_session(self):
         """Prepare a wetransfer.com session.
@@ -39,6 +180,7 @@ class WTSession(requests.Session):
         and with cookies properly populated that can be used for wetransfer
         requests.
         """
+        self.cookies.clear()
         r = self.get(WETRANSFER_URL)
         m = search(CSRF_REGEX, r.text)
         new_headers = {
@@ -47,12 +189,13 @@ class WTSession(requests.Session):
         }
         self.headers.update(new_headers)
 
-    def create_transfer_id(self, filenames: List[str], message: str) -> str:
+    def create_transfer_id(self, filenames: List[str], message: str, sizes: dict = None) -> str:
         """Given a list of filenames and a message prepare for the link upload.
         Return the parsed JSON response.
         """
+        sizes = sizes or {}
         j = {
-            "files": [self.file_name_and_size(f) for f in filenames],
+            "files": [self.file_name_and_size(f, sizes.get(f)) for f in filenames],
             "message": message,
             "ui_language": "en",
         }
@@ -61,98 +204,210 @@ class WTSession(requests.Session):
         return r.json()['id']
 
     @staticmethod
-    def file_name_and_size(file: str) -> dict:
-        """Given a file, prepare the "name" and "size" dictionary.
+    def file_name_and_size(file: str, size: int = None) -> dict:
+        """Given a file (and optionally its already known size), prepare the "name" and "size" dictionary.
         Return a dictionary with "name" and "size" keys.
         """
         filename = os.path.basename(file)
-        filesize = os.path.getsize(file)
+        filesize = size if size is not None else os.path.getsize(file)
 
         return {
             "name": filename,
             "size": filesize
         }
 
-    def prepare_file_upload(self, transfer_id: str, file: str) -> dict:
+    def prepare_file_upload(self, transfer_id: str, file: str, size: int = None) -> dict:
         """Given a transfer_id and file prepare it for the upload.
         Return the parsed JSON response.
         """
-        j = self.file_name_and_size(file)
-        r = self.post(WETRANSFER_FILES_URL.format(transfer_id=transfer_id), json=j)
-        return r.json()
+        j = self.file_name_and_size(file, size)
+        return self.transfer_request('post', WETRANSFER_FILES_URL.format(transfer_id=transfer_id), json=j)
 
     def upload_chunks(self, transfer_id: str, file_id: str, file: str,
-                      default_chunk_size: int = WETRANSFER_DEFAULT_CHUNK_SIZE) -> str:
-        """Given a transfer_id, file_id and file upload it.
+                      default_chunk_size: int = WETRANSFER_DEFAULT_CHUNK_SIZE, size: int = None,
+                      uploaded_chunks: Set[int] = frozenset()) -> str:
+        """Given a transfer_id, file_id and file upload it, skipping the given already uploaded chunks.
+        The file is memory-mapped, and every chunk is a memoryview slice of it - chunks are never copied.
+        Chunks are uploaded by 'upload_workers' threads, while the next chunks' CRC and
+        part URLs are already being prepared.
         Return the parsed JSON response.
         """
-        f = open(file, 'rb')
         file_name = os.path.basename(file)
         chunk_number = 0
 
-        while True:
-            chunk = f.read(default_chunk_size)
-            chunk_size = len(chunk)
-            stdout.flush()
-            if chunk_size == 0:
-                print(f"\r--> Finished uploading {file_name}.")
-                break
+        with open(file, 'rb') as f:
+            if size is None:
+                size = os.fstat(f.fileno()).st_size
+            if size:
+                with mmap(f.fileno(), 0, access=ACCESS_READ) as mapped_file, memoryview(mapped_file) as view:
+                    chunk_number = self._upload_view(transfer_id, file_id, file, view, default_chunk_size,
+                                                     uploaded_chunks)
+        print(f"\r--> Finished uploading {file_name}.")
 
-            chunk_number += 1
-            self.current_chunk += 1
-            print("\r--> {0:.2f}% uploaded...".format(self.current_chunk * 100 / self.total_chunks),
-                  f"Started uploading {file_name}...",
-                  sep=' // ', end='')
+        j = {'chunk_count': chunk_number}
+        url = WETRANSFER_FINALIZE_MPP_URL.format(transfer_id=transfer_id, file_id=file_id)
 
-            j = {
-                "chunk_crc": crc32(chunk),
-                "chunk_number": chunk_number,
-                "chunk_size": chunk_size,
-                "retries": 0
-            }
+        return self.transfer_request('put', url, json=j)
 
-            r = self.post(WETRANSFER_PART_PUT_URL.format(transfer_id=transfer_id, file_id=file_id), json=j)
-            url = r.json().get('url')
-            requests.options(url, headers=PUT_JSON)
-            requests.put(url, data=chunk)
+    def _upload_view(self, transfer_id: str, file_id: str, file: str, view: memoryview,
+                     chunk_size: int, uploaded_chunks: Set[int]) -> int:
+        """Upload the given file's memoryview in chunks of the given size, except for the uploaded chunks.
+        Return the number of the file's chunks.
+        """
+        pending_chunks = BoundedSemaphore(self.upload_workers * 2)
+        futures = []
+        chunk_number = 0
 
-        j = {'chunk_count': chunk_number}
-        r = self.put(WETRANSFER_FINALIZE_MPP_URL.format(transfer_id=transfer_id, file_id=file_id), json=j)
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            for chunk_number, offset in enumerate(range(0, len(view), chunk_size), start=1):
+                if chunk_number in uploaded_chunks:
+                    self._chunk_uploaded(file)
+                    continue
+                pending_chunks.acquire()
+                chunk = view[offset:offset + chunk_size]
+                try:
+                    url = self.get_part_put_url(transfer_id, file_id, chunk_number, chunk)
+                except Exception:
+                    chunk.release()
+                    raise
+                future = executor.submit(self.put_chunk, url, chunk, file, chunk_number)
+                future.add_done_callback(lambda _: pending_chunks.release())
+                futures.append(future)
+                del chunk
 
-        return r.json()
+            for future in futures:
+                future.result()
+        return chunk_number
+
+    def get_part_put_url(self, transfer_id: str, file_id: str, chunk_number: int, chunk: memoryview) -> str:
+        """Given a transfer_id, file_id and a chunk with its number, prepare the chunk for the upload.
+        Return the URL to PUT the chunk to.
+        """
+        j = {
+            "chunk_crc": crc32(chunk),
+            "chunk_number": chunk_number,
+            "chunk_size": len(chunk),
+            "retries": 0
+        }
+
+        url = WETRANSFER_PART_PUT_URL.format(transfer_id=transfer_id, file_id=file_id)
+        return self.transfer_request('post', url, json=j).get('url')
+
+    @timed('wetransfer_chunk')
+    def put_chunk(self, url: str, chunk: memoryview, file: str, chunk_number: int):
+        """Upload a given chunk of a file to its part URL, using the pooled parts session,
+        and record it in the journal.
+        The chunk is released once it was sent.
+        """
+        try:
+            self.parts_session.options(url, headers=PUT_JSON)
+            self.parts_session.put(url, data=chunk).raise_for_status()
+        finally:
+            chunk.release()
+        self.journal.add_chunk(file, chunk_number)
+        self._chunk_uploaded(file)
+
+    def _chunk_uploaded(self, file: str):
+        with self._progress_lock:
+            self.current_chunk += 1
+            print("\r--> {0:.2f}% uploaded...".format(self.current_chunk * 100 / self.total_chunks),
+                  f"Uploading {os.path.basename(file)}...",
+                  sep=' // ', end='', flush=True)
 
     def finalize_upload(self, transfer_id: str) -> dict:
         """Given a transfer_id finalize the upload.
         Return the parsed JSON response.
         """
-        r = self.put(WETRANSFER_FINALIZE_URL.format(transfer_id=transfer_id))
+        return self.transfer_request('put', WETRANSFER_FINALIZE_URL.format(transfer_id=transfer_id))
+
+    def transfer_request(self, method: str, url: str, **kwargs) -> dict:
+        """Send a request of a transfer. If the session was refused (its CSRF token or cookies
+        expired), prepare a new session and send the request once more.
+        Return the parsed JSON response (see 'transfer_json').
+        """
+        r = self.request(method, url, **kwargs)
+        if r.status_code in SESSION_EXPIRED_STATUSES:
+            self.prepare_session()
+            r = self.request(method, url, **kwargs)
+        return self.transfer_json(r)
 
+    @staticmethod
+    def transfer_json(r: requests.Response) -> dict:
+        """Given a response to a request of a transfer, raise TransferRejected if the transfer
+        is gone (a 404 or 410 status), or an HTTPError if the request failed otherwise.
+        Return the parsed JSON response.
+        """
+        if r.status_code in REJECTED_STATUSES:
+            raise TransferRejected(f"WeTransfer has no such transfer ({r.status_code}): {r.url}")
+        r.raise_for_status()
         return r.json()
 
-    def num_chunks(self, f):
-        return ceil(self.file_name_and_size(f)['size'] / WETRANSFER_DEFAULT_CHUNK_SIZE)
+    @staticmethod
+    def num_chunks(f, size: int = None):
+        size = size if size is not None else os.path.getsize(f)
+        return ceil(size / WETRANSFER_DEFAULT_CHUNK_SIZE)
 
     def upload(self, files: List[str], message: str = '') -> str:
         """
         Upload given files to wetransfer.com.
+        If a previous upload of the same files failed midway, only its missing chunks are uploaded.
         Return the shortened link.
         """
-        # Check that all files exists
+        # Check that all files exists, getting their sizes once
+        stats = {}
         for f in files:
-            if not os.path.exists(f):
+            try:
+                stats[f] = os.stat(f)
+            except FileNotFoundError:
                 raise FileNotFoundError(f)
+        sizes = {f: stat.st_size for f, stat in stats.items()}
 
-        self.total_chunks = sum([self.num_chunks(f) for f in files])
+        self.total_chunks = sum([self.num_chunks(f, sizes[f]) for f in files])
+        self.current_chunk = 0
 
         # Check that there are no duplicates filenames, despite possible different directories
         filenames = [os.path.basename(f) for f in files]
         if len(files) != len(set(filenames)):
             raise FileExistsError('Duplicate filenames')
 
-        transfer_id = self.create_transfer_id(files, message)
-
-        for f in files:
-            file_id = self.prepare_file_upload(transfer_id, f)['id']
-            self.upload_chunks(transfer_id, file_id, f)
+        transfer_id = self.journal.resume(files, stats, message)
+        if transfer_id:
+            print("--> Resuming a previous upload of these files...")
+            try:
+                return self._upload_transfer(transfer_id, files, sizes)
+            except TransferRejected as e:
+                print(f"\n--> The previous upload can't be resumed ({e}), starting a new one...")
+                self.current_chunk = 0
+        transfer_id = self.create_transfer_id(files, message, sizes)
+        self.journal.start(transfer_id, files, stats, message)
+        return self._upload_transfer(transfer_id, files, sizes)
 
-        return self.finalize_upload(transfer_id)['shortened_url']
+    def _upload_transfer(self, transfer_id: str, files: List[str], sizes: dict) -> str:
+        """
+        Upload given files to a given (new or resumed) transfer, skipping the journal's uploaded chunks.
+        The journal is removed once the transfer is finalized, or if the transfer was rejected,
+        and saved (with every acknowledged chunk) if the upload failed otherwise.
+        Return the shortened link.
+        """
+        try:
+            for f in files:
+                journal_file = self.journal.file(f)
+                if journal_file['finalized']:
+                    self.current_chunk += self.num_chunks(f, sizes[f])
+                    continue
+                file_id = journal_file['file_id']
+                if not file_id:
+                    file_id = self.prepare_file_upload(transfer_id, f, sizes[f])['id']
+                    self.journal.update_file(f, file_id=file_id)
+                self.upload_chunks(transfer_id, file_id, f, size=sizes[f],
+                                   uploaded_chunks=self.journal.uploaded_chunks(f))
+                self.journal.update_file(f, finalized=True)
+            shortened_url = self.finalize_upload(transfer_id)['shortened_url']
+        except TransferRejected:
+            self.journal.remove()
+            raise
+        except BaseException:
+            self.journal.save()
+            raise
+        self.journal.remove()
+        return shortened_url
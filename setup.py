@@ -19,7 +19,8 @@ setuptools.setup(
         "Development Status :: 4 - Beta",
         "Topic :: Multimedia :: Sound/Audio"
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     install_requires=['deemix==3.6.6', 'mutagen'],
-    entry_points={'console_scripts': ['segevmusic=segevmusic.music_downloader:main']}
+    entry_points={'console_scripts': ['segevmusic=segevmusic.music_downloader:main',
+                                      'segevmusic-server=segevmusic.server:main']}
 )
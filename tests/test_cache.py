@@ -0,0 +1,34 @@
+"""
+The response cache's running size, expiry and least recently used eviction.
+"""
+from segevmusic.cache import ResponseCache, EVICT_TO
+import pytest
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'), max_size=1000)
+    yield cache
+    cache.close()
+
+
+def test_size_counts_replaced_and_expired_entries(cache):
+    cache.set('a', b'x' * 100, 60)
+    cache.set('a', b'x' * 40, 60)
+    cache.set('b', b'x' * 10, -1)
+    assert cache.size == 50
+    assert cache.get('b') is None
+    assert cache.size == 40
+
+
+def test_least_recently_used_entries_are_evicted(cache):
+    for key in 'abcd':
+        cache.set(key, b'x' * 300, 60)
+    assert cache.get('a') is None
+    assert all(cache.get(key) for key in 'bcd')
+    assert cache.size <= 1000 * EVICT_TO
+
+    cache.get('b')
+    cache.set('e', b'x' * 300, 60)
+    assert cache.get('b') is not None
+    assert cache.get('c') is None
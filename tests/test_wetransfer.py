@@ -0,0 +1,120 @@
+"""
+Resuming WeTransfer uploads, against the local stand-in of WeTransfer's v4 endpoints (see benchmarks/upstream.py).
+"""
+from os import stat, listdir
+from os.path import dirname, join
+import sys
+import pytest
+
+sys.path.insert(0, join(dirname(dirname(__file__)), 'benchmarks'))
+
+from upstream import FakeUpstream, point_wetransfer_at  # noqa: E402
+from segevmusic import wetransfer  # noqa: E402
+from segevmusic.wetransfer import WTSession, TransferRejected  # noqa: E402
+
+CHUNK_SIZE = wetransfer.WETRANSFER_DEFAULT_CHUNK_SIZE
+FILE_SIZES = (3 * CHUNK_SIZE, 2 * CHUNK_SIZE + 1, 1000)
+TOTAL_CHUNKS = 3 + 3 + 1
+
+
+@pytest.fixture
+def upstream():
+    upstream = FakeUpstream(0, song_size=0, artwork_size=0, error_services=('wetransfer-parts',), seed=3).start()
+    point_wetransfer_at(upstream.base_url)
+    yield upstream
+    upstream.stop()
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = []
+    for index, size in enumerate(FILE_SIZES):
+        path = tmp_path / f"song-{index}.mp3"
+        path.write_bytes(bytes([index]) * size)
+        paths.append(str(path))
+    return paths
+
+
+def fail_some_parts(upstream: FakeUpstream, session: WTSession, files: list):
+    """
+    Uploads the given files while some part PUTs fail, until the upload fails with some of its chunks uploaded.
+    """
+    upstream.error_rate = 0.3
+    with pytest.raises(Exception) as error:
+        session.upload(files, 'songs')
+    assert not isinstance(error.value, TransferRejected)
+    upstream.error_rate = 0.0
+    assert upstream.injected_errors['wetransfer-parts']
+
+
+def uploaded_chunks(session: WTSession, files: list) -> int:
+    return sum(len(session.journal.uploaded_chunks(f)) for f in files)
+
+
+def journals(journals_dir: str) -> list:
+    try:
+        return listdir(journals_dir)
+    except FileNotFoundError:
+        return []
+
+
+def test_resume_sends_only_missing_chunks(upstream, files, tmp_path):
+    journals_dir = str(tmp_path / 'journals')
+    fail_some_parts(upstream, WTSession(journals_dir=journals_dir), files)
+
+    session = WTSession(journals_dir=journals_dir)
+    assert session.journal.resume(files, {f: stat(f) for f in files}, 'songs')
+    already_uploaded = uploaded_chunks(session, files)
+    assert 0 < already_uploaded < TOTAL_CHUNKS
+    parts_before = upstream.requests['wetransfer-parts']
+
+    link = session.upload(files, 'songs')
+
+    assert link.startswith(upstream.base_url)
+    assert len(upstream.transfers) == 1
+    assert upstream.requests['wetransfer-parts'] - parts_before == TOTAL_CHUNKS - already_uploaded
+    assert not journals(journals_dir)
+
+
+def test_expired_transfer_starts_a_new_one(upstream, files, tmp_path):
+    journals_dir = str(tmp_path / 'journals')
+    fail_some_parts(upstream, WTSession(journals_dir=journals_dir), files)
+    upstream.expire_transfers()
+    parts_before = upstream.requests['wetransfer-parts']
+
+    link = WTSession(journals_dir=journals_dir).upload(files, 'songs')
+
+    assert link.startswith(upstream.base_url)
+    assert len(upstream.transfers) == 1
+    assert upstream.requests['wetransfer-parts'] - parts_before == TOTAL_CHUNKS
+    assert not journals(journals_dir)
+
+
+def test_uploads_keep_their_own_journals(upstream, files, tmp_path):
+    journals_dir = str(tmp_path / 'journals')
+    fail_some_parts(upstream, WTSession(journals_dir=journals_dir), files[:2])
+    failed_journals = journals(journals_dir)
+    assert len(failed_journals) == 1
+
+    WTSession(journals_dir=journals_dir).upload(files[2:], 'songs')
+
+    assert journals(journals_dir) == failed_journals
+    session = WTSession(journals_dir=journals_dir)
+    assert session.journal.resume(files[:2], {f: stat(f) for f in files[:2]}, 'songs')
+    assert uploaded_chunks(session, files[:2])
+
+
+def test_expired_session_keeps_the_journal(upstream, files, tmp_path):
+    journals_dir = str(tmp_path / 'journals')
+    session = WTSession(journals_dir=journals_dir)
+    fail_some_parts(upstream, session, files)
+    already_uploaded = uploaded_chunks(session, files)
+    upstream.expire_csrf_token()
+    parts_before = upstream.requests['wetransfer-parts']
+
+    link = session.upload(files, 'songs')
+
+    assert link.startswith(upstream.base_url)
+    assert len(upstream.transfers) == 1
+    assert upstream.requests['wetransfer-parts'] - parts_before == TOTAL_CHUNKS - already_uploaded
+    assert not journals(journals_dir)